@@ -5,89 +5,598 @@
 # 
 # Banks use ZeroMQ to communicate with eachother.
 #
+import argparse
+import atexit
+import heapq
+import json
+import math
 import os
+import queue
+import signal
+import sqlite3
+import struct
 import sys
+import time
+import zlib
 
-import mysql.connector
 import logging
+import logging.handlers
+import random
 import zmq
-from random import randrange
+from array import array
+from collections import deque, OrderedDict
 
+try:
+	import mysql.connector
+except ImportError:
+	# only needed for MySQL storage
+	mysql = None
 
-class DbConnector:
+# Per-message records (received messages, DB updates, ...) are logged by their own logger,
+# so they can be rate limited and switched on/off independently of the rest of the log.
+MESSAGE_LOG = logging.getLogger("bank.messages")
+
+
+class StorageError(Exception):
+	"""
+	Storage operation failed and it's not known whether it was applied (e.g. connection broke
+	while waiting for the result). Such operation must not be repeated.
+	"""
+	pass
+
+
+class StorageUnavailableError(StorageError):
+	"""
+	Storage can't be reached. The operation wasn't executed, so it can be tried again later.
+	"""
+	pass
+
+
+class MySqlConnection:
+	"""
+	DB connection which is opened lazily and reopened after it breaks. Prepared cursors
+	(one per query) are kept for reuse.
+	"""
+
+	def __init__(self, connection_factory):
+		self._connection_factory = connection_factory
+		self._connection = None
+		self._cursors = {}
+		self._last_used = 0
+
+	def open(self):
+		"""
+		Opens the connection if it isn't open yet.
+		"""
+		if self._connection is None:
+			self._connection = self._connection_factory()
+			self._cursors = {}
+		return self._connection
+
+	def check(self, health_check_interval):
+		"""
+		Pings the connection if it was idle for more than health_check_interval seconds
+		and drops it if it's dead.
+		"""
+		if self._connection is None or time.monotonic() - self._last_used < health_check_interval:
+			return
+
+		try:
+			self._connection.ping(reconnect=False)
+		except mysql.connector.Error as e:
+			logging.warning("DB: Connection health check failed (%s), reconnecting.", e)
+			self.reset()
+
+	def cursor(self, query):
+		"""
+		Returns prepared cursor for given query.
+		"""
+		self._last_used = time.monotonic()
+		connection = self.open()
+		if query not in self._cursors:
+			self._cursors[query] = connection.cursor(prepared=True)
+		return self._cursors[query]
+
+	def reset(self):
+		"""
+		Drops the connection, new one will be opened on next use.
+		"""
+		try:
+			if self._connection is not None:
+				self._connection.close()
+		except mysql.connector.Error:
+			pass
+		self._connection = None
+		self._cursors = {}
+
+
+class StorageBackend:
 	"""
-	Implementation of DB connector.
+	Storage holding the bank account. DbConnector adds group commit and balance
+	caching on top of the backend.
+
+	Operations raise StorageUnavailableError if the storage can't be reached and StorageError
+	if the outcome of the operation is unknown.
 	"""
 
-	def __init__(self, host='localhost', user='root', password='r00t', schema='bank_server', account_id=1):
+	def add_to_balance(self, delta):
+		"""
+		Changes the balance by given (possibly negative) amount.
+
+		:param int delta: Balance change.
+		"""
+		raise NotImplementedError()
+
+	def debit_if_enough(self, amount, pending=0):
+		"""
+		Debits given amount if there's enough money in the account. Check and update have to be atomic.
+
+		:param int amount: Amount of money to debit.
+		:param int pending: Balance change not written yet (group commit), counted in the check.
+		:return: True if the money was debited.
+		"""
+		raise NotImplementedError()
+
+	def load_balance(self):
+		"""
+		Returns the balance stored in the account or None if there's no account.
+		"""
+		raise NotImplementedError()
+
+	def close(self):
+		pass
+
+
+class MySqlBackend(StorageBackend):
+	"""
+	Account stored in MySQL DB (see schema.sql).
+
+	Broken connection is reopened, so the bank survives DB restarts. Only opening of the connection
+	is retried (with exponential backoff, StorageUnavailableError is raised meanwhile). Updates are
+	not idempotent, so update which fails on an already open connection is never repeated and
+	StorageError is raised instead.
+	"""
+
+	def __init__(self, host='localhost', user='root', password='r00t', schema='bank_server', account_id=1,
+				 health_check_interval=30.0, max_reconnect_backoff=30.0):
+		"""
+		:param float health_check_interval: Idle time (in seconds) after which connection is checked before use.
+		:param float max_reconnect_backoff: Max time (in seconds) between attempts to connect to unavailable DB.
+		"""
+		if mysql is None:
+			raise RuntimeError("MySQL storage requires mysql-connector-python.")
+
 		self._host = host
 		self._user = user
 		self._password = password
 		self._schema = schema
 		self._account_id = account_id
-		self._connection = self._get_connection()
+		self._health_check_interval = health_check_interval
+		self._connection = MySqlConnection(self._get_connection)
+
+		self._max_reconnect_backoff = max_reconnect_backoff
+		self._reconnect_backoff = 0
+		self._reconnect_at = 0
 
 	def _get_connection(self):
+		# every statement is committed on its own, this saves one round trip per update
 		return mysql.connector.connect(
 			host=self._host,
 			user=self._user,
 			passwd=self._password,
-			database=self._schema
+			database=self._schema,
+			autocommit=True
 		)
 
-	def _perform_update_query(self, query, amount):
+	def _connect(self):
 		"""
-		Executes and commits the update query.
+		Makes sure the connection is open. Failed attempt postpones the next one (backoff doubles
+		with every failure).
+
+		:raise StorageUnavailableError: If the DB can't be reached.
 		"""
-		db = self._connection
-		cursor = db.cursor()
-		cursor.execute(query, (amount, self._account_id))
-		db.commit()
-		cursor.close()
+		now = time.monotonic()
+		if now < self._reconnect_at:
+			raise StorageUnavailableError("DB unavailable, next connection attempt in %.1f s" % (self._reconnect_at - now))
 
-	def close_connection(self):
+		try:
+			self._connection.check(self._health_check_interval)
+			self._connection.open()
+		except mysql.connector.Error as e:
+			self._connection.reset()
+			self._reconnect_backoff = min(self._max_reconnect_backoff, max(0.5, self._reconnect_backoff * 2))
+			self._reconnect_at = now + self._reconnect_backoff
+			logging.warning("DB: Can't connect (%s), next attempt in %.1f s.", e, self._reconnect_backoff)
+			raise StorageUnavailableError(str(e))
+
+		if self._reconnect_backoff > 0:
+			logging.info("DB: Connected again.")
+			self._reconnect_backoff = 0
+
+	def _execute(self, query, params, fetch=False):
+		"""
+		Executes query on the connection.
+
+		:param bool fetch: If set, fetched rows are returned instead of row count.
+		:raise StorageUnavailableError: If the DB can't be reached or select fails (safe to repeat).
+		:raise StorageError: If update fails on broken connection, the update may have been committed.
+		"""
+		self._connect()
+		try:
+			cursor = self._connection.cursor(query)
+			cursor.execute(query, params)
+			return cursor.fetchall() if fetch else cursor.rowcount
+		except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError) as e:
+			self._connection.reset()
+			if fetch:
+				raise StorageUnavailableError(str(e))
+			raise StorageError("Update failed on broken connection, it may have been committed: %s" % str(e))
+
+	def add_to_balance(self, delta):
+		self._execute("update account set balance = balance + %s where id = %s;", (delta, self._account_id))
+
+	def debit_if_enough(self, amount, pending=0):
+		return self._execute(
+			"update account set balance = balance - %s where id = %s and balance + %s >= %s;",
+			(amount, self._account_id, pending, amount)
+		) == 1
+
+	def load_balance(self):
+		rows = self._execute("select balance from account where id = %s", (self._account_id,), fetch=True)
+		return rows[0][0] if len(rows) > 0 else None
+
+	def close(self):
+		self._connection.reset()
+
+
+class SqliteBackend(StorageBackend):
+	"""
+	Account stored in SQLite DB, either in file or in memory (path ':memory:'). Table
+	is created if it doesn't exist.
+	"""
+
+	def __init__(self, path='bank.db', account_id=1, initial_balance=5000000):
+		self._account_id = account_id
+		self._connection = sqlite3.connect(path, isolation_level=None)
+		if path != ":memory:":
+			self._connection.execute("pragma journal_mode=wal;")
+		self._connection.execute(
+			"create table if not exists account (id integer primary key, balance integer not null);"
+		)
+		self._connection.execute(
+			"insert or ignore into account (id, balance) values (?, ?);",
+			(account_id, initial_balance)
+		)
+
+	def add_to_balance(self, delta):
+		self._connection.execute("update account set balance = balance + ? where id = ?;", (delta, self._account_id))
+
+	def debit_if_enough(self, amount, pending=0):
+		cursor = self._connection.execute(
+			"update account set balance = balance - ? where id = ? and balance + ? >= ?;",
+			(amount, self._account_id, pending, amount)
+		)
+		return cursor.rowcount == 1
+
+	def load_balance(self):
+		row = self._connection.execute("select balance from account where id = ?;", (self._account_id,)).fetchone()
+		return row[0] if row is not None else None
+
+	def close(self):
 		self._connection.close()
 
+
+class InMemoryBackend(StorageBackend):
+	"""
+	Account kept only in memory. Useful for measuring the system without DB costs.
+	"""
+
+	def __init__(self, initial_balance=5000000):
+		self._balance = initial_balance
+
+	def add_to_balance(self, delta):
+		self._balance += delta
+
+	def debit_if_enough(self, amount, pending=0):
+		if self._balance + pending < amount:
+			return False
+		self._balance -= amount
+		return True
+
+	def load_balance(self):
+		return self._balance
+
+
+class DbConnector:
+	"""
+	Implementation of DB connector. Account itself is stored by StorageBackend.
+
+	Optionally works in group-commit (write-behind) mode. In this mode credits and debits are not
+	written immediately but merged into one net balance change which is written by a single UPDATE
+	once the commit window is full (group_commit_size updates) or old enough (group_commit_interval).
+
+	Balance can also be cached in memory. The cache is loaded once and then kept up to date by credit_money()
+	and debit_money() so get_amount() doesn't have to query DB. This only works if the bank is the only one
+	who modifies the account, resync_balance() and verify_balance() can be used to check that.
+
+	While the storage is unavailable, credits and debits are kept as pending balance change (as in group
+	commit mode) and written once it's back. try_debit() refuses to debit meanwhile.
+	"""
+
+	def __init__(self, backend, group_commit_size=1, group_commit_interval=0.05, cache_balance=False, metrics=None):
+		"""
+		:param StorageBackend backend: Storage of the account.
+		:param int group_commit_size: Max number of balance updates merged into one commit. 1 disables group commit.
+		:param float group_commit_interval: Max age (in seconds) of pending balance updates before they are flushed.
+		:param bool cache_balance: If set, balance is loaded once and then served from memory.
+		:param Metrics metrics: Metrics to record latency of storage operations to.
+		"""
+		self._backend = backend
+		self._metrics = metrics if metrics is not None else Metrics()
+
+		self._group_commit_size = group_commit_size
+		self._group_commit_interval = group_commit_interval
+
+		# net balance change not yet written to DB
+		self._pending_delta = 0
+		self._pending_updates = 0
+		self._pending_since = None
+
+		# authoritative copy of balance, None if caching is disabled
+		self._cached_balance = None
+		if cache_balance:
+			self.resync_balance()
+
+	def close_connection(self):
+		if not self.flush():
+			logging.error("DB: Balance change %d couldn't be written before exit.", self._pending_delta)
+		self._backend.close()
+
+	def is_group_commit_enabled(self):
+		return self._group_commit_size > 1
+
+	def _add_pending(self, delta):
+		"""
+		Merges balance change into the pending commit window and flushes the window if it's full.
+
+		:param int delta: Balance change (positive for credit, negative for debit).
+		"""
+		if self._pending_updates == 0:
+			self._pending_since = time.monotonic()
+
+		self._pending_delta += delta
+		self._pending_updates += 1
+
+		if self._pending_updates >= self._group_commit_size:
+			self.flush()
+
+	def _update_balance(self, delta):
+		"""
+		Writes balance change to storage or merges it into pending changes if group commit is enabled
+		or earlier changes couldn't be written yet.
+		"""
+		if self.is_group_commit_enabled() or self._pending_updates > 0:
+			self._add_pending(delta)
+			return
+
+		try:
+			self._call_backend(self._backend.add_to_balance, delta)
+		except StorageUnavailableError:
+			self._add_pending(delta)
+		except StorageError as e:
+			self._metrics.count("db.unknown_outcome")
+			logging.error("DB: Balance change %d may not have been written: %s", delta, e)
+
+	def flush(self):
+		"""
+		Writes all pending balance changes to storage using one update. If the storage is unavailable,
+		changes are kept and the flush is retried after group commit interval.
+
+		:return: True if there are no pending changes left.
+		"""
+		if self._pending_updates == 0:
+			return True
+
+		MESSAGE_LOG.debug("DB: Flushing %d updates (net change %d)", self._pending_updates, self._pending_delta)
+		if self._pending_delta != 0:
+			# pending changes are dropped only once they are written, failed flush keeps them
+			try:
+				self._call_backend(self._backend.add_to_balance, self._pending_delta)
+			except StorageUnavailableError as e:
+				MESSAGE_LOG.warning("DB: Flush of %d updates postponed: %s", self._pending_updates, e)
+				self._pending_since = time.monotonic()
+				return False
+			except StorageError as e:
+				# repeating the update could apply it twice
+				self._metrics.count("db.unknown_outcome")
+				logging.error("DB: Balance change %d may not have been written: %s", self._pending_delta, e)
+
+		self._pending_delta = 0
+		self._pending_updates = 0
+		self._pending_since = None
+		return True
+
+	def flush_deadline(self):
+		"""
+		Returns monotonic time when pending balance changes have to be flushed or None if there are none.
+		"""
+		if self._pending_updates == 0:
+			return None
+		return self._pending_since + self._group_commit_interval
+
+	def flush_if_due(self):
+		"""
+		Flushes pending balance changes if they are older than the commit window interval.
+		"""
+		if self._pending_updates > 0 and time.monotonic() - self._pending_since >= self._group_commit_interval:
+			self.flush()
+
 	def credit_money(self, amount):
 		"""
 		Credits given amount of money to the account.
 		"""
-		logging.debug("DB: Crediting %d" % amount)
-		self._perform_update_query(
-			"update account set balance = balance + %s where id = %s;",
-			amount
-		)
+		MESSAGE_LOG.debug("DB: Crediting %d", amount)
+		if self._cached_balance is not None:
+			self._cached_balance += amount
+
+		self._update_balance(amount)
 
 	def debit_money(self, amount):
 		"""
 		Debits given amount of money from the account.
 		"""
-		logging.debug("DB: Debiting %d" % amount)
-		self._perform_update_query(
-			"update account set balance = balance - %s where id = %s;",
-			amount
-		)
+		MESSAGE_LOG.debug("DB: Debiting %d", amount)
+		if self._cached_balance is not None:
+			self._cached_balance -= amount
+
+		self._update_balance(-amount)
+
+	def try_debit(self, amount):
+		"""
+		Debits given amount of money from the account if there's enough money. Check and
+		update are done by one guarded statement, so no extra SELECT is needed. Pending
+		balance changes are passed to the guard instead of being flushed, so group commit
+		still merges the other updates.
+
+		:param int amount: Amount of money to debit.
+		:return: True if the money was debited.
+		"""
+		if self._cached_balance is not None:
+			# cache is authoritative, no need to ask DB
+			if self._cached_balance < amount:
+				return False
+			self.debit_money(amount)
+			return True
+
+		MESSAGE_LOG.debug("DB: Trying to debit %d", amount)
+		try:
+			return self._call_backend(self._backend.debit_if_enough, amount, self._pending_delta)
+		except StorageUnavailableError as e:
+			MESSAGE_LOG.warning("DB: Debit of %d refused, storage unavailable: %s", amount, e)
+		except StorageError as e:
+			self._metrics.count("db.unknown_outcome")
+			logging.error("DB: Debit of %d may have been written: %s", amount, e)
+		return False
 
 	def get_amount(self):
 		"""
-		Returns the current amount of money in the bank account.
+		Returns the current amount of money in the bank account. If the balance is cached,
+		no query is made.
+
+		:raise StorageUnavailableError: If the balance isn't cached and the storage is unavailable.
+		"""
+		if self._cached_balance is not None:
+			return self._cached_balance
+
+		return self._load_amount()
+
+	def resync_balance(self):
+		"""
+		Reloads the cached balance from DB (pending balance changes are flushed first).
+
+		:return: Balance loaded from DB.
+		"""
+		self._cached_balance = self._load_amount()
+		logging.info("DB: Balance cache synchronized: %s", self._cached_balance)
+		return self._cached_balance
+
+	def verify_balance(self):
+		"""
+		Compares the cached balance with the one stored in DB.
+
+		:return: True if the cache is disabled or the balances match.
+		"""
+		if self._cached_balance is None:
+			return True
+
+		db_balance = self._load_amount()
+		if db_balance != self._cached_balance:
+			logging.warning("DB: Cached balance %s differs from DB balance %s.", self._cached_balance, db_balance)
+			return False
+
+		return True
+
+	def _load_amount(self):
+		"""
+		Queries the current amount of money in the bank account. Pending balance changes
+		are flushed first, those which can't be written yet are added to the loaded balance.
+
+		:raise StorageUnavailableError: If the storage is unavailable.
+		"""
+		self.flush()
+		balance = self._call_backend(self._backend.load_balance)
+		return balance + self._pending_delta if balance is not None else None
+
+	def _call_backend(self, operation, *args):
 		"""
-		db = self._connection
-		cursor = db.cursor()
+		Calls storage operation and records its latency.
+		"""
+		started = time.perf_counter()
+		res = operation(*args)
+		self._metrics.observe("db_query", time.perf_counter() - started)
+		return res
+
 
-		cursor.execute("select balance from account")
-		return cursor.fetchone()[0]
+# Topologies of bank connections. In PAIR topology bank binds one PAIR socket for every
+# neighbour connecting to it. In ROUTER topology bank binds one ROUTER socket (to all its ports) for all neighbours
+# (which connect via DEALER sockets) and neighbours are identified by their routing identity.
+TOPOLOGY_PAIR = "pair"
+TOPOLOGY_ROUTER = "router"
+
+# Wire formats of messages sent between banks. Format is negotiated during handshake,
+# JSON is used if any side doesn't support binary format.
+WIRE_JSON = 0
+WIRE_BINARY = 1
+
+# Sockets used to report to the state collector. With PAIR every bank needs its own collector
+# port, with PUSH all banks can share one collector PULL socket.
+COLLECTOR_PAIR = "pair"
+COLLECTOR_PUSH = "push"
+
+# How recorded channel state is reported to the collector. Summary (number of messages, number
+# and sum of CREDIT messages) has constant size, histogram adds counts of CREDIT amounts
+# by power of two and full report contains every recorded message.
+CHANNEL_REPORT_SUMMARY = "summary"
+CHANNEL_REPORT_HISTOGRAM = "histogram"
+CHANNEL_REPORT_FULL = "full"
 
 
 class Message:
 	"""
-	Message sent between banks
+	Message sent between banks.
+
+	Message can be encoded either as JSON or as compact binary frame (1 byte type code followed
+	by 64 bit amount). Messages which can't be encoded in binary (e.g. unknown type) are always sent as JSON.
 	"""
 
+	__slots__ = ("type", "amount")
+
+	# binary frame: type code + amount
+	BINARY_FRAME = struct.Struct("!Bq")
+
+	TYPE_CODES = dict(CREDIT=1, DEBIT=2, REFUSED=3, CONNECT=4, MARKER=5, OK=6)
+
+	CODE_TYPES = {code: message_type for message_type, code in TYPE_CODES.items()}
+
 	@staticmethod
 	def from_dict(other):
 		return Message(other["type"], other["amount"])
 
+	@staticmethod
+	def decode(frame):
+		"""
+		Decodes message from received frame. Format is detected from the frame itself
+		(JSON frame always starts with '{').
+
+		:param bytes frame: Received frame.
+		:return: Decoded message.
+		"""
+		if frame[:1] == b"{":
+			return Message.from_dict(json.loads(frame.decode()))
+
+		code, amount = Message.BINARY_FRAME.unpack(frame)
+		return Message(Message.CODE_TYPES[code], amount)
+
 	@staticmethod
 	def credit(amount):
 		return Message("CREDIT", amount)
@@ -131,16 +640,87 @@ class Message:
 	def is_marker(self):
 		return self.type == "MARKER"
 
+	def is_transfer(self):
+		return self.type == "CREDIT" or self.type == "DEBIT" or self.type == "REFUSED"
+
 	def to_dict(self):
 		return dict(
 			type=self.type,
 			amount=self.amount
 		)
 
+	def encode(self, wire_format):
+		"""
+		Encodes message to frame.
+
+		:param int wire_format: WIRE_BINARY or WIRE_JSON.
+		:return: Encoded frame.
+		"""
+		if wire_format == WIRE_BINARY and self.type in Message.TYPE_CODES and isinstance(self.amount, int):
+			try:
+				return Message.BINARY_FRAME.pack(Message.TYPE_CODES[self.type], self.amount)
+			except struct.error:
+				# amount out of range
+				pass
+
+		return json.dumps(self.to_dict()).encode()
+
 	def __str__(self):
 		return str(self.to_dict())
 
 
+class ChannelRecording:
+	"""
+	Messages recorded on one channel. Only aggregates (and optionally histogram of CREDIT amounts)
+	are kept unless the full report is requested, then messages are stored as type codes and amounts
+	in two arrays. Either way recording a message doesn't allocate any object.
+	"""
+
+	__slots__ = ("count", "credits", "credit_sum", "histogram", "types", "amounts")
+
+	CREDIT_CODE = Message.TYPE_CODES["CREDIT"]
+
+	def __init__(self, report_mode=CHANNEL_REPORT_SUMMARY):
+		"""
+		:param str report_mode: One of CHANNEL_REPORT_* constants.
+		"""
+		self.count = 0
+		self.credits = 0
+		self.credit_sum = 0
+
+		# number of CREDIT amounts by their bit length (amount < 2^i)
+		self.histogram = array("q", [0] * 64) if report_mode == CHANNEL_REPORT_HISTOGRAM else None
+
+		self.types = array("b") if report_mode == CHANNEL_REPORT_FULL else None
+		self.amounts = array("q") if report_mode == CHANNEL_REPORT_FULL else None
+
+	def add(self, type_code, amount):
+		self.count += 1
+		if type_code == ChannelRecording.CREDIT_CODE:
+			self.credits += 1
+			self.credit_sum += amount
+			if self.histogram is not None:
+				self.histogram[amount.bit_length()] += 1
+
+		if self.types is not None:
+			self.types.append(type_code)
+			self.amounts.append(amount)
+
+	def to_list(self):
+		return [dict(type=Message.CODE_TYPES[t], amount=a) for t, a in zip(self.types, self.amounts)]
+
+	def summary(self):
+		res = dict(
+			messages=self.count,
+			credits=self.credits,
+			credit_sum=self.credit_sum
+		)
+		if self.histogram is not None:
+			# upper bound of amount -> number of CREDIT messages
+			res["credit_histogram"] = dict((str(1 << i), n) for i, n in enumerate(self.histogram) if n > 0)
+		return res
+
+
 class LocalState:
 	"""
 	Data structure to hold info about local state.
@@ -148,161 +728,788 @@ class LocalState:
 	This structure is valid for one instance of CH-L algorithm.
 	"""
 
-	def __init__(self, status, channel, max_channel_count):
+	def __init__(self, marker_id, status, channel, channels, report_mode=CHANNEL_REPORT_SUMMARY):
 		"""
 		Initializes new structure for capturing the local state.
 
+		:param int marker_id: Id of the snapshot.
 		:param int status: Status of the process - should be current amount of money in bank.
-		:param channel: Sender which has sent the MARKER message (empty message list is created)
-		:param int max_channel_count: Number of channels to record. After all channels are recorded, status
-		is marked as complete.
+		:param str channel: Channel from which the MARKER message was received (nothing is recorded on it),
+		None if this bank has initiated the algorithm.
+		:param list channels: Names of all channels. After all channels are recorded, status is marked as complete.
+		Markers from other channels (e.g. peer which became ready after the state was recorded) are ignored.
+		:param str report_mode: How channel state is reported, one of CHANNEL_REPORT_* constants.
 		:return:
 		"""
+		self.marker_id = marker_id
 		self._status = status
-		self._max_channel_count = max_channel_count
+		self._report_mode = report_mode
 
-		# each channel gets its own list for capturing messages
-		self._pending_channel_messages = dict()
+		# monotonic time when the state was recorded and number of recorded messages
+		self.started = time.monotonic()
+		self.recorded = 0
+
+		# channels still being recorded
+		self._pending_channel_messages = dict((c, ChannelRecording(report_mode)) for c in channels if c != channel)
 
 		# once the marker is received from channel, its' messages are moved
 		# from _pending_channel_message here
 		self._complete_chanel_messages = {}
 		if channel is not None:
-			self._complete_chanel_messages[channel] = []
+			self._complete_chanel_messages[channel] = ChannelRecording(self._report_mode)
 
-		# False by default but in some cases, state may be completed right
-		# at the beginning of algorithm
-		self._complete = len(self._complete_chanel_messages) == max_channel_count
+	def pending_channels(self):
+		return list(self._pending_channel_messages.keys())
 
-	def add_message(self, channel, message):
+	def add_message(self, channel, type_code, amount):
 		"""
 		Adds message for given channel.
 
-		:param channel: Channel from which the message was received.
+		:param str channel: Channel from which the message was received.
+		:param int type_code: Type code of the message (see Message.TYPE_CODES).
+		:param int amount: Amount of the message.
+		:return:
+		"""
+		self._pending_channel_messages[channel].add(type_code, amount)
+		self.recorded += 1
+
+	def is_complete(self):
+		"""
+		State is complete once no channel is being recorded (this may be right at the beginning of algorithm).
+		"""
+		return len(self._pending_channel_messages) == 0
+
+	def mark_channel_as_complete(self, channel):
+		"""
+		Moves messages for this channel from pending to complete list.
+
+		:param str channel: Channel on which communication is to be recorded no longer.
+		:return:
+		"""
+		logging.debug("Marking channel '%s' as complete.", channel)
+
+		if channel in self._pending_channel_messages:
+			self._complete_chanel_messages[channel] = self._pending_channel_messages.pop(channel)
+		elif channel in self._complete_chanel_messages:
+			logging.warning("Duplicate marker %s from channel '%s' ignored.", self.marker_id, channel)
+		else:
+			logging.warning("Marker %s from channel '%s' which isn't part of the snapshot ignored.",
+							self.marker_id, channel)
+
+		logging.debug("Remaining pending channels: %d.", len(self._pending_channel_messages))
+		logging.debug("Complete channels: %d.", len(self._complete_chanel_messages))
+
+	def to_dict(self):
+		if self._report_mode == CHANNEL_REPORT_FULL:
+			return dict(
+				status=self._status,
+				channel_messages=dict((c, r.to_list()) for c, r in self._complete_chanel_messages.items())
+			)
+
+		return dict(
+			status=self._status,
+			channel_summaries=dict((c, r.summary()) for c, r in self._complete_chanel_messages.items())
+		)
+
+
+class StatesHolder:
+	"""
+	Class that holds info about all local states of one bank (more than snapshot can be taken at a time).
+	Number of states and number of messages recorded by one state are limited, snapshots exceeding
+	the limits (or running for too long) are supposed to be aborted by the bank.
+	"""
+
+	# number of finished snapshots remembered, so late markers don't start them again
+	FINISHED_MARKERS = 1024
+
+	def __init__(self, max_states=16, max_messages=100000, report_mode=CHANNEL_REPORT_SUMMARY):
+		"""
+		:param int max_states: Max number of snapshots taken at a time.
+		:param int max_messages: Max number of messages recorded by one snapshot. Applies only to full
+		reports, other reports have constant size.
+		:param str report_mode: How channel state is reported, one of CHANNEL_REPORT_* constants.
+		"""
+		self._max_states = max_states
+		self._max_messages = max_messages if report_mode == CHANNEL_REPORT_FULL else None
+		self._report_mode = report_mode
+
+		# marker_id -> state, ordered from the oldest one
+		self._states = OrderedDict()
+
+		# marker_id -> None, ids of completed or aborted snapshots
+		self._finished = OrderedDict()
+
+		# channel -> states which are still recording it, so the cost of capturing a message
+		# depends only on number of snapshots recording its channel
+		self._recording = {}
+
+	def any_capture_active(self):
+		"""
+		Checks if any snapshot of global state is being taken at a time.
+		:return:
+		"""
+		return len(self._states) > 0
+
+	def new_global_state(self, marker_id, status, sender, channels):
+		"""
+		Adds a new global state structure for given marker_id.
+
+		:param int marker_id: Unique id of marker message.
+		:param int status: Node status.
+		:param str sender: Channel from which the MARKER message was received, None for the initiator.
+		:param list channels: Names of all channels to record.
+		:return:
+		"""
+		state = LocalState(marker_id, status, sender, channels, self._report_mode)
+		self._states[marker_id] = state
+		for channel in state.pending_channels():
+			self._recording.setdefault(channel, []).append(state)
+
+	def is_full(self):
+		return len(self._states) >= self._max_states
+
+	def oldest_marker(self):
+		"""
+		Returns id of the oldest running snapshot or None if there's none.
+		"""
+		return next(iter(self._states), None)
+
+	def expired_markers(self, timeout):
+		"""
+		Returns ids of snapshots running for longer than given timeout.
+
+		:param float timeout: Timeout in seconds.
+		"""
+		deadline = time.monotonic() - timeout
+		return [marker_id for marker_id, state in self._states.items() if state.started < deadline]
+
+	def is_finished(self, marker_id):
+		"""
+		Checks if the snapshot with given marker_id has already been completed or aborted.
+		"""
+		return marker_id in self._finished
+
+	def is_state_recorded(self, marker_id):
+		"""
+		Checks if the state for given marker_id was already recorded.
+		:param int marker_id: Id of marker.
+		:return:
+		"""
+		return marker_id in self._states
+
+	def capture_message(self, channel, message):
+		"""
+		Adds message received on given channel to all local states still recording the channel.
+
+		:param str channel: Channel the message was received from.
 		:param Message message: Received message.
+		:return: None or list of marker ids of snapshots which have exceeded the message limit.
+		"""
+		states = self._recording.get(channel)
+		if not states:
+			return None
+
+		overflown = None
+		type_code = Message.TYPE_CODES[message.type]
+		for state in states:
+			state.add_message(channel, type_code, message.amount)
+			if self._max_messages is not None and state.recorded > self._max_messages:
+				if overflown is None:
+					overflown = []
+				overflown.append(state.marker_id)
+		return overflown
+
+	def _stop_recording(self, state, channel):
+		states = self._recording.get(channel)
+		if states is not None and state in states:
+			states.remove(state)
+			if len(states) == 0:
+				self._recording.pop(channel)
+
+	def mark_channel_as_complete(self, marker_id, sender):
+		"""
+		Marks channel in state object given by marker_id as complete and messages will
+		no longer be recorded for this channel.
+
+		:param int marker_id: Id of marker message.
+		:param str sender: Channel from which the marker message was received.
 		:return:
 		"""
-		if channel not in self._pending_channel_messages and channel not in self._complete_chanel_messages:
-			self._pending_channel_messages[channel] = []
+		if marker_id in self._states:
+			state = self._states[marker_id]
+			self._stop_recording(state, sender)
+			state.mark_channel_as_complete(sender)
 
-		self._pending_channel_messages[channel].append(message)
+	def is_status_complete(self, marker_id):
+		"""
+		Checks if the status with given marker_id si complete.
+		:param int marker_id: Id of MARKER message.
+		:return: True if the status is complete.
+		"""
+		if marker_id in self._states:
+			c = self._states[marker_id].is_complete()
+			logging.debug("Local state: marker_id=%s; complete=%s", marker_id, c)
+			return c
+		else:
+			return False
 
-	def is_complete(self):
-		return self._complete
+	def get_state(self, marker_id):
+		return self._states[marker_id]
+
+	def clear_state(self, marker_id):
+		"""
+		Clears state for given marker id.
+
+		:param str marker_id:
+		:return:
+		"""
+		if marker_id in self._states:
+			state = self._states.pop(marker_id)
+			for channel in state.pending_channels():
+				self._stop_recording(state, channel)
+
+		self._finished[marker_id] = None
+		if len(self._finished) > StatesHolder.FINISHED_MARKERS:
+			self._finished.popitem(last=False)
+
+
+class DeltaReporter:
+	"""
+	Turns local states into reports for the collector. With deltas enabled, report contains only
+	difference against the previously reported state (balance change and changes of channel
+	summaries, unchanged channels are left out) and every full_every-th report is full, so
+	the collector can rebuild full states from a base report and deltas. Channels which have
+	appeared since the previous report are sent whole, removed ones are listed by name.
+	"""
+
+	def __init__(self, delta_reports=False, full_every=10):
+		"""
+		:param bool delta_reports: Whether to report deltas. Full channel reports (message lists) are always reported whole.
+		:param int full_every: Every n-th report is full.
+		"""
+		self._delta_reports = delta_reports
+		self._full_every = max(1, full_every)
+
+		# previously reported marker_id and local state, number of reports since the last full one
+		self._previous_marker = None
+		self._previous_state = None
+		self._since_full = 0
+
+	@staticmethod
+	def _diff(current, previous):
+		"""
+		Returns difference of two (possibly nested) dicts of numbers, zero values are left out.
+		"""
+		res = dict()
+		for key in set(current.keys()) | set(previous.keys()):
+			value = current.get(key, 0)
+			if isinstance(value, dict) or isinstance(previous.get(key), dict):
+				diff = DeltaReporter._diff(current.get(key, dict()), previous.get(key, dict()))
+				if len(diff) > 0:
+					res[key] = diff
+			elif value - previous.get(key, 0) != 0:
+				res[key] = value - previous.get(key, 0)
+		return res
+
+	def report(self, marker_id, local_state):
+		"""
+		Creates report of given local state.
+
+		:param int marker_id: Id of the snapshot.
+		:param dict local_state: Local state (see LocalState.to_dict).
+		:return: Dict with either full local state or delta (base_marker_id, status_delta, channel_deltas
+		and optionally new_channels and removed_channels).
+		"""
+		full = not self._delta_reports or "channel_summaries" not in local_state \
+			or self._previous_state is None or self._since_full + 1 >= self._full_every
+
+		if full:
+			report = dict(local_state)
+			self._since_full = 0
+		else:
+			current = local_state["channel_summaries"]
+			previous = self._previous_state["channel_summaries"]
+			report = dict(
+				base_marker_id=self._previous_marker,
+				status_delta=local_state["status"] - self._previous_state["status"],
+				channel_deltas=DeltaReporter._diff(dict((c, v) for c, v in current.items() if c in previous),
+												   dict((c, v) for c, v in previous.items() if c in current))
+			)
+			new_channels = dict((c, v) for c, v in current.items() if c not in previous)
+			if len(new_channels) > 0:
+				report["new_channels"] = new_channels
+			removed_channels = [c for c in previous if c not in current]
+			if len(removed_channels) > 0:
+				report["removed_channels"] = removed_channels
+			self._since_full += 1
+
+		self._previous_marker = marker_id
+		self._previous_state = local_state
+		return report
+
+
+class RateLimitFilter(logging.Filter):
+	"""
+	Lets through at most given number of records per second, the rest is dropped.
+	Number of dropped records is logged when the next second starts.
+	"""
+
+	def __init__(self, rate):
+		"""
+		:param int rate: Max number of records per second.
+		"""
+		super().__init__()
+		self.rate = rate
+		self._window = 0
+		self._passed = 0
+		self._dropped = 0
+
+	def filter(self, record):
+		window = int(record.created)
+		if window != self._window:
+			if self._dropped > 0:
+				logging.warning("%d log records of '%s' dropped by rate limit.", self._dropped, record.name)
+			self._window = window
+			self._passed = 0
+			self._dropped = 0
+
+		if self._passed >= self.rate:
+			self._dropped += 1
+			return False
+
+		self._passed += 1
+		return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+	"""
+	Queue handler which leaves formatting of records to the listener thread, so logging
+	thread only pays for creating the record. Arguments of log records therefore must not
+	be modified after they are logged.
+	"""
+
+	def prepare(self, record):
+		if record.exc_info:
+			# traceback has to be rendered while it still exists
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
+
+class Histogram:
+	"""
+	Latency histogram with log-linear buckets: every power of two (in microseconds) is split
+	into 4 buckets, so the relative error of percentiles is below 25 %. Recording a value is
+	just a few integer operations and memory doesn't grow with number of values.
+	"""
+
+	BUCKET_COUNT = 160
+
+	def __init__(self):
+		self._buckets = [0] * Histogram.BUCKET_COUNT
+		self.count = 0
+		self.total = 0.0
+
+	@staticmethod
+	def _bucket(us):
+		if us < 4:
+			return us
+		bits = us.bit_length() - 1
+		return min(Histogram.BUCKET_COUNT - 1, 4 * (bits - 1) + ((us >> (bits - 2)) & 3))
+
+	@staticmethod
+	def bucket_upper_bound(bucket):
+		"""
+		Returns upper bound (in microseconds) of given bucket.
+		"""
+		if bucket < 4:
+			return bucket + 1
+		bits = bucket // 4 + 1
+		return (5 + bucket % 4) << (bits - 2)
+
+	def observe(self, seconds):
+		"""
+		Records one value.
+
+		:param float seconds: Measured time in seconds.
+		"""
+		self._buckets[Histogram._bucket(int(seconds * 1000000))] += 1
+		self.count += 1
+		self.total += seconds
+
+	def percentile(self, p):
+		"""
+		Returns upper bound (in ms) of the bucket containing given percentile or None if there are no values.
+		"""
+		if self.count == 0:
+			return None
+
+		rank = max(1, int(math.ceil(self.count * p / 100.0)))
+		seen = 0
+		for bucket, n in enumerate(self._buckets):
+			seen += n
+			if seen >= rank:
+				return Histogram.bucket_upper_bound(bucket) / 1000.0
+
+	def to_dict(self):
+		return dict(
+			count=self.count,
+			mean_ms=self.total * 1000.0 / self.count if self.count > 0 else None,
+			p50_ms=self.percentile(50),
+			p90_ms=self.percentile(90),
+			p99_ms=self.percentile(99),
+			# [upper bound in ms, count] of non-empty buckets
+			buckets=[[Histogram.bucket_upper_bound(b) / 1000.0, n] for b, n in enumerate(self._buckets) if n > 0]
+		)
+
+
+class Metrics:
+	"""
+	Counters and latency histograms of the bank: messages, DB queries, round trip of DEBIT
+	messages (DEBIT sent -> CREDIT with the same amount received from the same peer),
+	snapshots and iterations of the main loop. Bank is single-threaded, so no locking is needed.
+	"""
+
+	# number of the latest initiated snapshots whose start times are kept
+	SNAPSHOT_HISTORY = 1000
+
+	def __init__(self):
+		self._started = time.time()
+		self._counters = dict()
+		self._histograms = dict()
+
+		# start times of the latest snapshots initiated by this bank
+		self._snapshots = deque(maxlen=Metrics.SNAPSHOT_HISTORY)
+
+		# peer name -> (amount, send time) of DEBIT messages waiting for response
+		self._pending_debits = dict()
+
+	def count(self, name, value=1):
+		self._counters[name] = self._counters.get(name, 0) + value
+
+	def observe(self, name, seconds):
+		"""
+		Records measured time to the histogram with given name.
+		"""
+		histogram = self._histograms.get(name)
+		if histogram is None:
+			histogram = Histogram()
+			self._histograms[name] = histogram
+		histogram.observe(seconds)
+
+	def debit_sent(self, peer, amount):
+		if peer.name not in self._pending_debits:
+			self._pending_debits[peer.name] = deque(maxlen=100000)
+		self._pending_debits[peer.name].append((amount, time.perf_counter()))
+
+	def response_received(self, peer, message):
+		"""
+		Matches CREDIT or REFUSED message with the oldest DEBIT sent to the peer. Peer answers
+		DEBITs in order, so CREDIT with different amount is not a response but a transfer.
+		"""
+		pending = self._pending_debits.get(peer.name)
+		if pending is None or len(pending) == 0:
+			return
+
+		amount, sent = pending[0]
+		if message.is_credit() and message.amount != amount:
+			return
+
+		pending.popleft()
+		if message.is_credit():
+			self.observe("debit_round_trip", time.perf_counter() - sent)
+
+	def snapshot_started(self, marker_id):
+		self._snapshots.append(dict(marker_id=marker_id, time=time.time()))
+
+	def to_dict(self):
+		return dict(
+			started=self._started,
+			run_time=time.time() - self._started,
+			counters=self._counters,
+			histograms=dict((name, histogram.to_dict()) for name, histogram in self._histograms.items()),
+			snapshots=list(self._snapshots)
+		)
+
+
+class Scheduler:
+	"""
+	Timer queue driving the bank's event loop. Loop waits for messages only until
+	the next timer is due, so idle bank doesn't wake up needlessly.
+	"""
+
+	def __init__(self):
+		# heap of (time, sequence number, callback)
+		self._timers = []
+		self._sequence = 0
+
+	def call_later(self, delay, callback):
+		"""
+		Schedules callback to be called after given delay.
+
+		:param float delay: Delay in seconds.
+		:param callback: Function without arguments.
+		"""
+		self.call_at(time.monotonic() + delay, callback)
+
+	def call_at(self, when, callback):
+		"""
+		Schedules callback to be called at given time.
+
+		:param float when: Monotonic time.
+		:param callback: Function without arguments.
+		"""
+		self._sequence += 1
+		heapq.heappush(self._timers, (when, self._sequence, callback))
 
-	def mark_channel_as_complete(self, channel):
+	def call_every(self, interval, callback):
 		"""
-		Moves messages for this channel from pending to complete list.
+		Schedules callback to be called periodically.
 
-		:param channel: Channel on which communication is to be recorded no longer.
-		:return:
+		:param float interval: Interval in seconds.
+		:param callback: Function without arguments.
 		"""
-		logging.debug("Marking channel '%s' as complete." % channel)
+		def periodic():
+			callback()
+			self.call_later(interval, periodic)
 
-		if channel in self._pending_channel_messages:
-			self._complete_chanel_messages[channel] = self._pending_channel_messages[channel]
-			self._pending_channel_messages.pop(channel)
-		else:
-			self._complete_chanel_messages[channel] = []
+		self.call_later(interval, periodic)
 
-		logging.debug("Remaining pending channels: %s." % str(len(self._pending_channel_messages)))
-		logging.debug("Complete channels: %s." % str(len(self._complete_chanel_messages)))
-		logging.debug("Max channel count: %s." % self._max_channel_count)
-		if len(self._complete_chanel_messages) == self._max_channel_count:
-			self._complete = True
+	def next_deadline(self):
+		"""
+		Returns monotonic time of the next timer or None if there's none.
+		"""
+		return self._timers[0][0] if len(self._timers) > 0 else None
 
-	def to_dict(self):
-		return dict(
-			status=self._status,
-			channel_messages=self._pending_channel_messages
-		)
+	def run_due(self):
+		"""
+		Calls all callbacks which are due.
+		"""
+		now = time.monotonic()
+		while len(self._timers) > 0 and self._timers[0][0] <= now:
+			_, _, callback = heapq.heappop(self._timers)
+			callback()
 
 
-class StatesHolder:
+class LoadGenerator:
 	"""
-	Class that holds info about all local states of one bank (more than snapshot can be taken at a time).
+	Decides when messages are generated and what they look like. Messages arrive with given
+	rate (per second) either in constant intervals or as Poisson process. Amounts are drawn
+	from selected distribution. All random choices use one RNG which can be seeded.
 	"""
 
-	def __init__(self):
-		# marker_id -> state
-		self._states = {}
+	ARRIVALS = ["poisson", "constant"]
 
-	def any_capture_active(self):
+	AMOUNTS = ["uniform", "constant", "exponential"]
+
+	def __init__(self, rate=20.0, arrivals="poisson", amounts="uniform", min_amount=10000, max_amount=50000,
+				 seed=None):
 		"""
-		Checks if any snapshot of global state is being taken at a time.
-		:return:
+		:param float rate: Number of generated messages per second, 0 disables generation.
+		:param str arrivals: Distribution of arrivals, one of ARRIVALS.
+		:param str amounts: Distribution of amounts, one of AMOUNTS. Constant amount is the mean of min and max.
+		:param int min_amount: Min amount of money in one message.
+		:param int max_amount: Max amount of money in one message.
+		:param seed: Seed of the RNG, None for random seed.
 		"""
-		return len(self._states) > 0
+		self.rate = rate
+		self._arrivals = arrivals
+		self._amounts = amounts
+		self._min_amount = min_amount
+		self._max_amount = max_amount
+		self._random = random.Random(seed)
 
-	def new_global_state(self, marker_id, status, sender, max_channel_count):
+	def is_enabled(self):
+		return self.rate > 0
+
+	def next_delay(self):
 		"""
-		Adds a new global state structure for given marker_id.
+		Returns time (in seconds) until the next message.
+		"""
+		if self._arrivals == "constant":
+			return 1.0 / self.rate
+		return self._random.expovariate(self.rate)
 
-		:param int marker_id: Unique id of marker message.
-		:param int status: Node status.
-		:param sender: Sender who has sent the MARKER message.
-		:param int max_channel_count: Number of channels to record.
-		:return:
+	def next_amount(self):
 		"""
-		self._states[marker_id] = LocalState(status, sender, max_channel_count)
+		Returns amount of the next message.
+		"""
+		if self._amounts == "constant":
+			return (self._min_amount + self._max_amount) // 2
+		elif self._amounts == "exponential":
+			mean = (self._max_amount - self._min_amount) / 2.0
+			return min(self._max_amount, self._min_amount + int(self._random.expovariate(1.0 / mean)))
+		return self._random.randint(self._min_amount, self._max_amount)
 
-	def is_state_recorded(self, marker_id):
+	def choose_target(self, peers):
 		"""
-		Checks if the state for given marker_id was already recorded.
-		:param int marker_id: Id of marker.
-		:return:
+		Chooses one of the peers as a target of the next message.
 		"""
-		return marker_id in self._states
+		return peers[self._random.randrange(len(peers))]
 
-	def capture_message(self, sender, message):
+	def choose_credit(self):
 		"""
-		Adds message from given sender to all global states.
+		Decides whether the next message should be CREDIT (or DEBIT).
+		"""
+		return self._random.randrange(2) == 0
 
-		:param sender: Sender of the message.
-		:param Message message: Received message.
-		:return:
+
+class Peer:
+	"""
+	Channel to one neighbour bank.
+
+	Transfer messages (CREDIT, DEBIT, REFUSED) are not sent right away but collected in outbox
+	and sent together as one multipart frame once there's batch_size of them, they are older than
+	batch_timeout or other message (e.g. MARKER) is sent. Order of messages is always kept.
+
+	Peers connected to ROUTER socket share the socket and are distinguished by their routing identity.
+
+	Batches are sent without blocking. Batches libzmq doesn't accept (the peer is slow and high-water mark
+	was reached) wait in backlog and sending is retried by timer. Peer with max_backlog messages in backlog
+	is congested: bank doesn't generate new messages for it until the backlog is halved.
+
+	Batch is removed from backlog only after libzmq accepts it. Batches may carry CREDITs already
+	withdrawn from the balance, so batch which fails (e.g. ROUTER peer has disconnected) is kept and
+	retried as well, otherwise the money would be lost.
+	"""
+
+	# how often is sending of backlog retried (in seconds)
+	RETRY_INTERVAL = 0.005
+
+	def __init__(self, socket, name, ready, batch_size=1, batch_timeout=0.005, identity=None, scheduler=None,
+				 max_backlog=10000, on_congestion=None):
+		"""
+		:param socket: ZeroMQ socket of the channel.
+		:param str name: Name of the channel (address of the peer or listening port).
+		:param bool ready: Whether the handshake was already done.
+		:param int batch_size: Max number of messages sent in one batch.
+		:param float batch_timeout: Max time (in seconds) message can wait in outbox.
+		:param bytes identity: Routing identity of the peer if the socket is ROUTER, None otherwise.
+		:param Scheduler scheduler: Scheduler used to flush outbox after batch timeout and to retry sending of backlog.
+		:param int max_backlog: Number of messages in backlog which makes the peer congested.
+		:param on_congestion: Function called with the peer when it becomes congested or stops being congested.
 		"""
+		self.socket = socket
+		self.name = name
+		self.ready = ready
+		self.identity = identity
 
-		for marker_id, status in self._states:
-			status.add_message(sender, message)
+		# handshake is always done in JSON
+		self.wire_format = WIRE_JSON
 
-	def mark_channel_as_complete(self, marker_id, sender):
+		self._batch_size = batch_size
+		self._batch_timeout = batch_timeout
+		self._scheduler = scheduler
+
+		# encoded frames waiting to be sent
+		self._outbox = []
+		self._outbox_since = None
+
+		# batches (lists of frames) not accepted by libzmq yet and number of messages in them
+		self._backlog = deque()
+		self._backlog_messages = 0
+		self._max_backlog = max_backlog
+		self._retry_scheduled = False
+		self._on_congestion = on_congestion
+		self.congested = False
+
+		# error of the last failed send, None if the last send succeeded
+		self.send_error = None
+
+	def send(self, message):
 		"""
-		Marks channel in state object given by marker_id as complete and messages will
-		no longer be recorded for this channel.
+		Sends message to this peer in negotiated wire format.
 
-		:param int marker_id: Id of marker message.
-		:param sender: Channel from which the marker message was received.
-		:return:
+		:param Message message: Message to send.
 		"""
-		if marker_id in self._states:
-			self._states[marker_id].mark_channel_as_complete(sender)
+		if len(self._outbox) == 0:
+			self._outbox_since = time.monotonic()
+			if self._scheduler is not None and self._batch_size > 1:
+				self._scheduler.call_later(self._batch_timeout, self._flush_timeout)
+		self._outbox.append(message.encode(self.wire_format))
 
-	def is_status_complete(self, marker_id):
+		if len(self._outbox) >= self._batch_size or not message.is_transfer():
+			self.flush()
+
+	def flush(self):
 		"""
-		Checks if the status with given marker_id si complete.
-		:param int marker_id: Id of MARKER message.
-		:return: True if the status is complete.
+		Sends all messages waiting in outbox as one batch.
 		"""
-		if marker_id in self._states:
-			c = self._states[marker_id].is_complete()
-			logging.debug("Local state: marker_id=%s; complete=%s" % (marker_id, str(c)))
-			return c
-		else:
-			return False
+		if len(self._outbox) == 0:
+			return
 
-	def get_state(self, marker_id):
-		return self._states[marker_id]
+		count = len(self._outbox)
+		if self.identity is not None:
+			self._outbox.insert(0, self.identity)
+		self._backlog.append(self._outbox)
+		self._backlog_messages += count
+		self._outbox = []
+		self._outbox_since = None
+		self._send_backlog()
+
+	def backlog_size(self):
+		return self._backlog_messages
+
+	def _send_backlog(self):
+		"""
+		Sends batches from backlog until libzmq stops accepting them.
+		"""
+		while len(self._backlog) > 0:
+			batch = self._backlog[0]
+			try:
+				self.socket.send_multipart(batch, zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			except zmq.ZMQError as e:
+				# ROUTER doesn't know the identity (peer has disconnected), batch is kept until it reconnects
+				if self.send_error is None:
+					logging.error("Sending to %s failed, %d messages kept in backlog: %s.",
+								  self.name, self._backlog_messages, e)
+				self.send_error = e
+				break
+
+			if self.send_error is not None:
+				logging.info("Sending to %s recovered.", self.name)
+				self.send_error = None
+			self._backlog.popleft()
+			self._backlog_messages -= len(batch) - (1 if self.identity is not None else 0)
+
+		congested = self._backlog_messages >= self._max_backlog \
+			or (self.congested and self._backlog_messages > self._max_backlog // 2)
+		if congested != self.congested:
+			self.congested = congested
+			if self._on_congestion is not None:
+				self._on_congestion(self)
+
+		if len(self._backlog) > 0 and not self._retry_scheduled and self._scheduler is not None:
+			self._retry_scheduled = True
+			self._scheduler.call_later(Peer.RETRY_INTERVAL, self._retry)
+
+	def _retry(self):
+		self._retry_scheduled = False
+		if not self.socket.closed:
+			self._send_backlog()
+
+	def _flush_timeout(self):
+		"""
+		Flushes outbox if the oldest message waits longer than batch timeout. If the batch the
+		timer was set for was already sent, newer batch has its own timer.
+		"""
+		if len(self._outbox) > 0 and time.monotonic() - self._outbox_since >= self._batch_timeout:
+			self.flush()
 
-	def clear_state(self, marker_id):
+	@staticmethod
+	def decode_batch(frames):
 		"""
-		Clears state for given marker id.
+		Decodes batch of messages.
 
-		:param str marker_id:
-		:return:
+		:param list frames: Received frames.
+		:return: List of received messages.
 		"""
-		if marker_id in self._states:
-			self._states.pop(marker_id)
+		return [Message.decode(frame) for frame in frames]
+
+	def __str__(self):
+		return self.name
 
 
 class Bank:
@@ -310,15 +1517,45 @@ class Bank:
 	Implementation of the bank server.
 	"""
 
-	def __init__(self, bank_id, host, ports, debug, db_connector, other_banks, state_collector):
+	def __init__(self, bank_id, host, ports, debug, db_connector, other_banks, state_collector,
+				 wire_format=WIRE_BINARY, batch_size=1, batch_timeout=0.005, topology=TOPOLOGY_PAIR, recv_budget=64,
+				 load_generator=None, stats_file=None, metrics=None, control_port=None,
+				 snapshot_timeout=30.0, max_snapshots=16, snapshot_max_messages=100000,
+				 collector_socket=COLLECTOR_PAIR, marker_file=True, snapshot_interval=None,
+				 channel_report=CHANNEL_REPORT_SUMMARY, delta_reports=False, full_report_every=10,
+				 handshake_timeout=1.0, handshake_max_backoff=30.0, send_hwm=1000, recv_hwm=1000, max_backlog=10000):
 		"""
 		Initializes this server with given values.
 
 		:param string bank_id: Id of this bank (unique in distributed system).
 		:param string host: IP address of this bank.
 		:param list ports: Ports this bank should listen on. If empty, bank will not expect any connections.
+		In ROUTER topology one ROUTER socket is bound to all of them.
 		:param list other_banks: List of banks this one should connect to via ZeroMQ. Each entry should be in format <host>:<port>.
 		:param string state_collector: Address and port of state collector.
+		:param int wire_format: Preferred wire format of messages sent to other banks.
+		:param int batch_size: Max number of messages sent to peer in one batch.
+		:param float batch_timeout: Max time (in seconds) message can wait for batch to be sent.
+		:param str topology: TOPOLOGY_PAIR or TOPOLOGY_ROUTER.
+		:param int recv_budget: Max number of batches received from one socket per poll.
+		:param LoadGenerator load_generator: Generator of messages, default one is used if not set.
+		:param str stats_file: File to write metrics to when the bank stops.
+		:param Metrics metrics: Metrics of the bank, new ones are created if not set.
+		:param str control_port: Port of control endpoint (REP socket answering e.g. stats requests), None to disable it.
+		:param float snapshot_timeout: Time (in seconds) after which unfinished snapshot is aborted.
+		:param int max_snapshots: Max number of snapshots taken at a time, the oldest one is aborted when exceeded.
+		:param int snapshot_max_messages: Max number of channel messages recorded by one snapshot.
+		:param str collector_socket: COLLECTOR_PAIR or COLLECTOR_PUSH.
+		:param bool marker_file: Whether to check the MARKER file for starting snapshots.
+		:param float snapshot_interval: Interval (in seconds) of periodic snapshots, None to disable them.
+		:param str channel_report: How channel state is reported to the collector, one of CHANNEL_REPORT_* constants.
+		:param bool delta_reports: Report differences against the previous report instead of full local states.
+		:param int full_report_every: With delta reports, every n-th report is full.
+		:param float handshake_timeout: Time (in seconds) to wait for handshake response before it's retried.
+		:param float handshake_max_backoff: Max time (in seconds) to wait for handshake response, timeout doubles with every retry.
+		:param int send_hwm: Send high-water mark (in batches) of sockets to other banks.
+		:param int recv_hwm: Receive high-water mark (in batches) of sockets to other banks.
+		:param int max_backlog: Number of unsent messages which makes peer congested (see Peer).
 		"""
 
 		self._bank_id = bank_id
@@ -326,33 +1563,86 @@ class Bank:
 		self._ports = ports
 		self._debug = debug
 		self._db_connector = db_connector
+		self._wire_format = wire_format
+		self._batch_size = batch_size
+		self._batch_timeout = batch_timeout
+		self._topology = topology
+		self._recv_budget = recv_budget
 		self._context = zmq.Context()
 
-		# coefficient used in randrage() to decide
-		# whether a message should be generated or not
-		self._max_time_between_messages = 5
+		# decides when and what messages are generated
+		self._load_generator = load_generator if load_generator is not None else LoadGenerator()
 
-		# sockets bank is listening on
-		self._my_sockets = []
+		# time of the next generated message and max number of messages generated
+		# at once when the loop falls behind
+		self._next_generation = None
+		self._max_generation_burst = 100
 
-		# socket to given peer can be accessed as _peers["host:port"]
-		self._peers = []
+		# how often is the MARKER file checked (in seconds), the check is optional as snapshots
+		# can be started via control endpoint
+		self._marker_file = marker_file
+		self._marker_check_interval = 0.1
 
-		# whether or not can messages be sent/received through main socket
+		# interval of periodic snapshots and number of the current schedule (older timers are ignored)
+		self._snapshot_interval = snapshot_interval
+		self._snapshot_schedule = 0
+
+		# timers of the event loop
+		self._scheduler = Scheduler()
+
+		# max time (in ms) the loop waits for messages, so the stop request is noticed
+		self._max_poll_timeout = 1000
+
+		self._metrics = metrics if metrics is not None else Metrics()
+		self._stats_file = stats_file
+
+		# time when the last poll returned
+		self._iteration_started = time.perf_counter()
+
+		# marker_id -> time when this bank recorded its state
+		self._snapshot_start_times = dict()
+
+		self._control_port = control_port
+		self._control_socket = None
+
+		# peers bank is listening for
 		# when client connects to this socket, simple handshake will happen
-		# which will set this condition to True
-		self._sockets_ready = dict()
+		# which will make the peer ready
+		self._my_peers = []
+
+		# peers this bank has connected to
+		self._peers = []
+
+		# socket -> peer, for sockets which belong to exactly one peer
+		self._socket_peers = dict()
+
+		# address -> peer this bank is doing handshake with, and time of the first attempt
+		self._handshakes = dict()
+		self._handshake_started = dict()
+		self._handshake_timeout = handshake_timeout
+		self._handshake_max_backoff = handshake_max_backoff
+
+		self._send_hwm = send_hwm
+		self._recv_hwm = recv_hwm
+		self._max_backlog = max_backlog
+
+		# ROUTER socket (ROUTER topology only) and peers connected to it by their identity
+		self._router_socket = None
+		self._router_peers = dict()
 
 		# Condition for main server loop
 		self._should_run = True
 
 		# object for collecting global status
-		self._status_holder = StatesHolder()
+		self._status_holder = StatesHolder(max_snapshots, snapshot_max_messages, channel_report)
+		self._reporter = DeltaReporter(delta_reports, full_report_every)
+		self._snapshot_timeout = snapshot_timeout
 
-		# flag indicating whether a CH-L algorithm
-		# initiated by this bank is currently running
-		self._ch_l_running = False
+		# marker ids are (time in ms << 16) | bank bits, last used time keeps them unique
+		self._marker_bank_bits = (int(bank_id) if str(bank_id).isdigit() else zlib.crc32(str(bank_id).encode())) & 0xFFFF
+		self._last_marker_time = 0
 
+		self._collector_socket_type = zmq.PUSH if collector_socket == COLLECTOR_PUSH else zmq.PAIR
 		self._connect_to_state_collector(state_collector)
 
 		self._init_queues(other_banks)
@@ -366,79 +1656,176 @@ class Bank:
 		:return:
 		"""
 		logging.info("Connecting to state collector on address: %s.", state_collector)
-		self._collector_socket = self._context.socket(zmq.PAIR)
-		self._collector_socket.connect("tcp://%s" % state_collector)
-		self._collector_socket.send_json(Message("Bank '%s' connected." % self._bank_id, -1).to_dict())
-
-	def _peer_handshake(self, other_peer):
-		"""
-		Do the initial handshake with peer this bank is trying to connect to.
-		:param string other_peer: Address bank is trying to connect to
-		:return: Socket if handshake is successful.
-		"""
-
-		logging.info("Handshake with \"%s\"." % other_peer)
-		s = self._context.socket(zmq.PAIR)
-		s.connect("tcp://%s" % other_peer)
-		s.send_json(Message.connect().to_dict())
-		resp = s.recv_json()
-		msg = Message.from_dict(resp)
-		if msg.is_ok():
-			logging.info("Handshake successful.")
-			return s
+		self._collector_socket = self._context.socket(self._collector_socket_type)
+		self._collector_socket.connect(to_endpoint(state_collector))
+		message = Message("Bank '%s' connected." % self._bank_id, -1).to_dict()
+		# collector learns which banks have to report every snapshot
+		message["bank_id"] = self._bank_id
+		self._collector_socket.send_json(message)
+
+	def _start_handshake(self, address):
+		"""
+		Starts handshake with peer this bank is trying to connect to. CONNECT message is sent
+		and the peer becomes ready once OK arrives (see _check_connection_message). If it doesn't
+		arrive in time, CONNECT is sent again with longer timeout.
+
+		:param string address: Address bank is trying to connect to.
+		"""
+		if self._topology == TOPOLOGY_ROUTER:
+			s = self._create_socket(zmq.DEALER)
+			s.setsockopt(zmq.IDENTITY, self._bank_id.encode())
 		else:
-			logging.warning("Bad handshake response: %s.", str(msg))
-			return None
+			s = self._create_socket(zmq.PAIR)
+		s.connect(to_endpoint(address))
+		peer = self._create_peer(s, address)
+		self._handshakes[address] = peer
+		self._socket_peers[s] = peer
+		self._poller.register(s, zmq.POLLIN)
+		self._handshake_started[address] = time.perf_counter()
+		self._send_connect(peer, 0)
+
+	def _send_connect(self, peer, attempt):
+		"""
+		Sends CONNECT message to the peer and schedules check of the handshake.
+
+		:param int attempt: Number of previous attempts.
+		"""
+		logging.info("Handshake with \"%s\" (attempt %d).", peer.name, attempt + 1)
+		# amount of CONNECT message is the preferred wire format
+		# and OK message contains the agreed one
+		peer.send(Message(Message.connect().type, self._wire_format))
+
+		self._schedule_handshake_check(peer, attempt)
+
+	def _schedule_handshake_check(self, peer, attempt):
+		"""
+		Schedules check of the handshake, timeout doubles with every attempt.
+		"""
+		timeout = min(self._handshake_timeout * (2 ** attempt), self._handshake_max_backoff)
+		self._scheduler.call_later(timeout, lambda: self._on_handshake_timeout(peer, attempt))
+
+	def _on_handshake_timeout(self, peer, attempt):
+		"""
+		Repeats CONNECT if the handshake hasn't finished yet. The socket is kept (ZeroMQ reconnects
+		it by itself): slow peer may have already answered and started to send transfers on it.
+		Duplicate CONNECT is answered by another OK which is ignored.
+		"""
+		if peer.ready or self._handshakes.get(peer.name) is not peer:
+			return
+
+		logging.warning("Handshake with \"%s\" timed out, retrying.", peer.name)
+		self._metrics.count("handshakes.retried")
+		if peer.backlog_size() > 0:
+			# previous CONNECT hasn't even been accepted by the socket yet
+			self._schedule_handshake_check(peer, attempt + 1)
+			return
+		self._send_connect(peer, attempt + 1)
+
+	def _finish_handshake(self, peer, message):
+		"""
+		Makes peer ready after OK message was received from it.
+		"""
+		self._handshakes.pop(peer.name)
+		peer.ready = True
+		peer.wire_format = message.amount if message.amount >= 0 else WIRE_JSON
+		self._peers.append(peer)
+		self._metrics.observe("handshake", time.perf_counter() - self._handshake_started.pop(peer.name))
+		logging.info("Handshake with \"%s\" successful, wire format: %d.", peer.name, peer.wire_format)
 
 	def _init_queues(self, other_banks):
 		"""
 		Initializes connections to other banks and starts to listen on given port (if the port is set).
+		Handshakes with other banks run concurrently, each of them becomes available once it's finished.
 
 		:param list other_banks:
 		"""
 
 		self._poller = zmq.Poller()
 
+		if self._control_port is not None:
+			logging.info("Control endpoint listening on port %s.", self._control_port)
+			self._control_socket = self._context.socket(zmq.REP)
+			self._control_socket.bind(to_endpoint(self._control_port, bind=True))
+			self._poller.register(self._control_socket, zmq.POLLIN)
+
+		if self._topology == TOPOLOGY_ROUTER:
+			self._init_router()
+
 		# start listening if ports are set
-		for port in self._ports:
-			logging.info("Listening on port: %s." % port)
-			socket = self._context.socket(zmq.PAIR)
-			socket.bind("tcp://*:%s" % port)
-			self._my_sockets.append(socket)
+		for port in self._ports if self._topology == TOPOLOGY_PAIR else []:
+			logging.info("Listening on port: %s.", port)
+			socket = self._create_socket(zmq.PAIR)
+			socket.bind(to_endpoint(port, bind=True))
+			peer = self._create_peer(socket, "*:%s" % port)
+			self._my_peers.append(peer)
+			self._socket_peers[socket] = peer
 			self._poller.register(socket, zmq.POLLIN)
-			self._sockets_ready[socket] = False
 
-		# connect to neighbours
+		# connect to neighbours, handshakes finish in the main loop
 		for other_bank in other_banks:
 			logging.info("Connecting to: %s.", other_bank)
-			s = self._peer_handshake(other_bank)
-			if s is not None:
-				self._peers.append(s)
-				self._poller.register(s, zmq.POLLIN)
+			self._start_handshake(other_bank)
 
-	def _get_available_peers(self, include_my_if_not_ready=False):
+	def _create_socket(self, socket_type):
+		"""
+		Creates socket for communication with other banks.
 		"""
-		Returns all sockets - peers + the ones bank is listening on.
+		s = self._context.socket(socket_type)
+		s.setsockopt(zmq.SNDHWM, self._send_hwm)
+		s.setsockopt(zmq.RCVHWM, self._recv_hwm)
+		return s
 
-		:param bool include_my_if_not_ready: If the flag is set, my sockets will be included even if it is not ready yet.
+	def _create_peer(self, socket, name, identity=None):
 		"""
-		peers = [] + self._peers
+		Creates peer (not ready yet) communicating over given socket.
+		"""
+		return Peer(socket, name, False, self._batch_size, self._batch_timeout, identity, self._scheduler,
+					self._max_backlog, self._on_peer_congestion)
 
-		for my_socket in self._my_sockets:
-			if include_my_if_not_ready or self._sockets_ready[my_socket]:
-				peers.append(my_socket)
+	def _on_peer_congestion(self, peer):
+		"""
+		Called when peer becomes congested or stops being congested. Only generation of new messages
+		is throttled (see _generate_message), the socket is still read: if both ends of the channel
+		stopped reading, neither backlog would ever drain.
+		"""
+		if peer.congested:
+			logging.warning("Peer %s is congested (%d unsent messages).", peer.name, peer.backlog_size())
+			self._metrics.count("peers.congested")
+		else:
+			logging.info("Peer %s is no longer congested.", peer.name)
 
-		return peers
+	def _init_router(self):
+		"""
+		Binds ROUTER socket all neighbours will connect to. Peers are created
+		once their first message arrives. The socket is bound to all configured ports,
+		so configuration written for PAIR topology works too.
+		"""
+		if len(self._ports) == 0:
+			return
+
+		self._router_socket = self._create_socket(zmq.ROUTER)
+		# reconnecting peer takes over its old identity
+		self._router_socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+		# full peer makes send fail instead of silently dropping the message
+		self._router_socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+		for port in self._ports:
+			logging.info("Listening on port: %s (ROUTER).", port)
+			self._router_socket.bind(to_endpoint(port, bind=True))
+		self._poller.register(self._router_socket, zmq.POLLIN)
 
-	def _check_amount(self, amount):
+	def _get_available_peers(self, include_my_if_not_ready=False):
 		"""
-		Checks whether given amount of money can be withdrawn.
+		Returns all peers - the ones bank connected to + the ones bank is listening for.
 
-		:param int amount: Amount of money to withdraw.
-		:return: True if the amount is ok.
+		:param bool include_my_if_not_ready: If the flag is set, my peers will be included even if they are not ready yet.
 		"""
-		curr_amount = self._db_connector.get_amount()
-		return curr_amount >= amount
+		peers = [] + self._peers
+
+		for my_peer in self._my_peers:
+			if include_my_if_not_ready or my_peer.ready:
+				peers.append(my_peer)
+
+		return peers
 
 	def start_server(self):
 		"""
@@ -446,12 +1833,80 @@ class Bank:
 		"""
 
 		logging.info("Starting receive/send loop.")
+		if self._marker_file:
+			self._scheduler.call_every(self._marker_check_interval, self._check_marker_file)
+		self._schedule_snapshots(self._snapshot_interval)
+		self._scheduler.call_every(min(1.0, self._snapshot_timeout / 4), self._expire_snapshots)
+		self._schedule_message_generation()
+
 		while self._should_run:
-			self._check_marker_file()
-			self._recv_messages()
+			self._recv_messages(self._get_poll_timeout())
+			self._scheduler.run_due()
+			self._db_connector.flush_if_due()
+			self._metrics.observe("loop_iteration", time.perf_counter() - self._iteration_started)
+
+		for peer in self._get_available_peers(True):
+			peer.flush()
+			if peer.backlog_size() > 0:
+				MESSAGE_LOG.debug("%d messages for %s not sent.", peer.backlog_size(), peer.name)
+		self._write_stats()
+		logging.info("Loop finished gracefully.")
+
+	def stop(self):
+		"""
+		Requests the main loop to stop.
+		"""
+		self._should_run = False
+
+	def _write_stats(self):
+		"""
+		Writes metrics to the stats file (if it's set).
+		"""
+		if self._stats_file is None:
+			return
+
+		with open(self._stats_file, "w") as f:
+			json.dump(self._metrics.to_dict(), f)
+
+	def _get_poll_timeout(self):
+		"""
+		Returns time (in ms) the loop can wait for incoming messages, that is time until
+		the next timer or pending DB flush.
+		"""
+		deadlines = [d for d in (self._scheduler.next_deadline(), self._db_connector.flush_deadline()) if d is not None]
+		if len(deadlines) == 0:
+			return self._max_poll_timeout
+
+		return min(self._max_poll_timeout, max(0, int(math.ceil((min(deadlines) - time.monotonic()) * 1000))))
+
+	def _schedule_message_generation(self):
+		"""
+		Schedules first message generation.
+		"""
+		if not self._load_generator.is_enabled():
+			logging.info("Message generation disabled.")
+			return
+
+		self._next_generation = time.monotonic() + self._load_generator.next_delay()
+		self._scheduler.call_at(self._next_generation, self._on_generation_timer)
+
+	def _on_generation_timer(self):
+		"""
+		Generates all messages which are due (timer may fire late when the rate is high)
+		and schedules the next one. If the loop can't keep up, the backlog is skipped.
+		"""
+		now = time.monotonic()
+		generated = 0
+		while self._next_generation <= now and generated < self._max_generation_burst:
 			self._generate_message()
+			self._next_generation += self._load_generator.next_delay()
+			generated += 1
 
-		logging.info("Loop finished gracefully.")
+		if self._next_generation <= now:
+			logging.warning("Message generation can't keep up with rate %s/s, skipping backlog.", self._load_generator.rate)
+			self._next_generation = now + self._load_generator.next_delay()
+
+		self._scheduler.call_at(self._next_generation, self._on_generation_timer)
 
 	def _generate_message(self):
 		"""
@@ -466,63 +1921,181 @@ class Bank:
 		if len(peers) == 0:
 			return
 
-		# random time between messages
-		if randrange(self._max_time_between_messages) != 0:
+		# congested peers would only grow their backlog
+		peers = [peer for peer in peers if not peer.congested]
+		if len(peers) == 0:
+			self._metrics.count("generation.skipped")
 			return
 
-		logging.debug("Generating message.")
+		MESSAGE_LOG.debug("Generating message.")
 
-		amount = 10000 + randrange(40001)
-		rand = randrange(len(peers))
-		target = peers[rand]
+		amount = self._load_generator.next_amount()
+		target = self._load_generator.choose_target(peers)
 
-		rand = randrange(2)
-		if rand == 0 and self._check_amount(amount):
-			self._send_credit(amount, target)
-		else:
+		if not self._load_generator.choose_credit() or not self._try_send_credit(amount, target):
 			self._send_debit(amount, target)
 
-	def _check_connection_message(self, message, socket):
+	def _check_connection_message(self, message, peer):
 		"""
 		Checks for incoming CONNECT message on main socket. If it is, OK message is immediately sent back.
-		Otherwise REFUSED is sent back
+		Otherwise REFUSED is sent back. For peers this bank is connecting to, OK message finishes the handshake.
 
-		:param Message message: Received message.
+		:param Message message: Received message. Its amount is wire format preferred by the peer (-1 for JSON).
+		:param Peer peer: Peer which has sent the message.
 		:return:
 		"""
 
-		if message.is_connect():
-			logging.info("Connection message received on main socket. Main socket ready.")
-			socket.send_json(Message.ok().to_dict())
-			self._sockets_ready[socket] = True
+		if message.is_ok() and self._handshakes.get(peer.name) is peer:
+			self._finish_handshake(peer, message)
+		elif self._handshakes.get(peer.name) is peer:
+			# peer bank is connecting to only answers with OK
+			logging.warning("Unexpected message during handshake with \"%s\": %s.", peer.name, message)
+		elif message.is_connect():
+			wire_format = min(message.amount, self._wire_format) if message.amount >= 0 else WIRE_JSON
+			logging.info("Connection message received on main socket. Main socket ready, wire format: %d.", wire_format)
+			peer.send(Message(Message.ok().type, wire_format))
+			peer.ready = True
+			peer.wire_format = wire_format
 		else:
 			logging.warning("Wrong message received on main socket.")
-			socket.send_json(Message.refused().to_dict())
+			peer.send(Message.refused())
 
-	def _recv_messages(self):
+	def _recv_messages(self, timeout):
 		"""
-		Poll for messages from ZeroMQ. Timeout is between 10 and 100 ms.
+		Poll for messages from ZeroMQ. Every ready socket is drained until it's empty
+		or recv budget is used up.
+
+		:param int timeout: Poll timeout in ms, None to wait until message arrives.
 		"""
-		t = 10
-		socks = dict(self._poller.poll(timeout=t))
+		socks = self._poller.poll(timeout=timeout)
+		self._iteration_started = time.perf_counter()
 
 		if len(socks) > 0:
-			logging.debug("%d sockets polled." % len(socks))
+			MESSAGE_LOG.debug("%d sockets polled.", len(socks))
+
+			for socket, event in socks:
+				if event & zmq.POLLIN:
+					self._drain_socket(socket)
+
+	def _drain_socket(self, socket):
+		"""
+		Receives and dispatches batches from socket without blocking.
+
+		:param socket: Socket which is ready for reading.
+		"""
+		for _ in range(self._recv_budget):
+			try:
+				frames = socket.recv_multipart(zmq.NOBLOCK)
+			except zmq.Again:
+				return
+
+			if socket is self._control_socket:
+				self._handle_control_request(frames)
+			elif socket is self._router_socket:
+				self._dispatch_router_frames(frames)
+			else:
+				self._dispatch_messages(Peer.decode_batch(frames), self._socket_peers[socket])
+
+	def _handle_control_request(self, frames):
+		"""
+		Handles request received on the control endpoint. Request is JSON object with 'command' field,
+		supported commands:
+			stats - returns current metrics
+			log-level - sets 'level' of logger 'logger' (root logger if not set)
+			snapshot - starts new snapshot and returns its marker_id
+			schedule - starts snapshots every 'interval' seconds (stops them if interval isn't set)
+			peers - returns names of ready peers and of peers handshake is running with
+
+		Every request gets a response, invalid request gets one with 'error' field.
+
+		:param list frames: Received frames.
+		"""
+		try:
+			request = json.loads(frames[-1].decode())
+			command = request.get("command")
+		except (ValueError, AttributeError):
+			# UnicodeDecodeError is ValueError too
+			logging.warning("Invalid control request received.")
+			self._control_socket.send_json(dict(error="Invalid request, JSON object expected."))
+			return
+
+		logging.info("Control command received: %s.", command)
+		try:
+			response = self._run_control_command(command, request)
+		except Exception as e:
+			logging.exception("Control command %s failed.", command)
+			response = dict(error="Command %s failed: %s" % (command, str(e)))
+
+		self._control_socket.send_json(response)
+
+	def _run_control_command(self, command, request):
+		"""
+		Runs command received on the control endpoint (see _handle_control_request).
+
+		:return: Response (dict).
+		"""
+		if command == "stats":
+			response = self._metrics.to_dict()
+		elif command == "log-level":
+			try:
+				set_log_level(request.get("level"), request.get("logger"))
+				response = dict(ok=True)
+			except ValueError as e:
+				response = dict(error=str(e))
+		elif command == "peers":
+			response = dict(ready=[peer.name for peer in self._get_available_peers()],
+							connecting=list(self._handshakes.keys()),
+							failing=[peer.name for peer in self._get_available_peers(True) if peer.send_error is not None])
+		elif command == "snapshot":
+			response = dict(marker_id=self._start_snapshot())
+		elif command == "schedule":
+			try:
+				self._schedule_snapshots(float(request["interval"]) if request.get("interval") else None)
+				response = dict(ok=True)
+			except (TypeError, ValueError) as e:
+				response = dict(error=str(e))
+		else:
+			response = dict(error="Unknown command: %s." % command)
+
+		return response
+
+	def _dispatch_router_frames(self, frames):
+		"""
+		Dispatches one batch received on ROUTER socket. Peer is identified by routing identity,
+		unknown identity means new neighbour which is expected to do handshake.
+
+		:param list frames: Received frames, first one is the identity.
+		"""
+		identity = frames[0]
+		if identity not in self._router_peers:
+			logging.info("New peer connected to ROUTER: %s.", identity)
+			peer = self._create_peer(self._router_socket, identity.decode(errors="replace"), identity)
+			self._router_peers[identity] = peer
+			self._my_peers.append(peer)
 
-			# find which socket has received the message
-			for socket in self._get_available_peers(True):
-				if socket in socks and socks[socket] == zmq.POLLIN:
-					msg = Message.from_dict(socket.recv_json())
-					logging.info("Message received: %s." % msg)
+		self._dispatch_messages(Peer.decode_batch(frames[1:]), self._router_peers[identity])
 
-					if self._is_my_socket_that_is_not_ready(socket):
-						# message on main socket that is not ready yet received
-						# check if it's connection or not
-						self._check_connection_message(msg, socket)
+	def _dispatch_messages(self, messages, peer):
+		"""
+		Handles batch of messages received from peer.
+
+		:param list messages: Received messages.
+		:param Peer peer: Sender of the messages.
+		"""
+		for msg in messages:
+			MESSAGE_LOG.debug("Message received: %s.", msg)
+			self._metrics.count("messages_in.%s" % msg.type)
+
+			if not peer.ready:
+				# message on main socket that is not ready yet received
+				# check if it's connection or not
+				self._check_connection_message(msg, peer)
 
-					else:
-						# receive normal message from socket
-						self._process_message(msg, socket)
+			else:
+				# receive normal message from socket
+				started = time.perf_counter()
+				self._process_message(msg, peer)
+				self._metrics.observe("process_message", time.perf_counter() - started)
 
 	def _process_message(self, message, sender):
 		"""
@@ -530,21 +2103,33 @@ class Bank:
 		REFUSE will bse sent back to SENDER.
 		
 		:param Message message: Message received from queue.
-		:param Socket sender: Sender of the received message.
+		:param Peer sender: Sender of the received message.
 		"""
 
+		if message.is_transfer():
+			# channel state of running snapshots
+			overflown = self._status_holder.capture_message(sender.name, message)
+			if overflown is not None:
+				for marker_id in overflown:
+					self._abort_snapshot(marker_id, "too many channel messages")
+
 		if message.is_credit():
+			self._metrics.response_received(sender, message)
 			self._credit(message.amount)
 		elif message.is_debit():
-			if self._check_amount(message.amount):
-				self._debit(message.amount, sender)
-			else:
-				self._send_refuse(sender)
+			self._debit(message.amount, sender)
 		elif message.is_marker():
-			logging.info("Processing marker message: %s." % str(message))
+			logging.info("Processing marker message: %s.", message)
 			self._handle_global_state(message, sender)
+		elif message.is_connect():
+			# peer has reconnected (or repeated its handshake)
+			self._check_connection_message(message, sender)
+		elif message.is_ok():
+			# response to repeated CONNECT
+			MESSAGE_LOG.debug("Duplicate OK from %s.", sender)
 		else:
-			logging.info("Refused from %s." % str(sender))
+			self._metrics.response_received(sender, message)
+			MESSAGE_LOG.debug("Refused from %s.", sender)
 
 	def _handle_global_state(self, message, sender):
 		"""
@@ -557,23 +2142,36 @@ class Bank:
 		"""
 		marker_id = message.amount
 
+		if self._status_holder.is_finished(marker_id):
+			logging.info("Snapshot %s already finished, ignoring marker from %s.", marker_id, sender)
+			return
+
 		if not self._status_holder.is_state_recorded(marker_id):
-			logging.info("Status for marker '%s' not recorded yet." % marker_id)
+			logging.info("Status for marker '%s' not recorded yet.", marker_id)
+			if self._status_holder.is_full():
+				self._abort_snapshot(self._status_holder.oldest_marker(), "too many running snapshots")
+
 			# 1. mark my current state and send markers to other peers (state = amount of money in the bank)
 			# 2. mark the state of sender as empty list
-			self._mark_my_status(marker_id, sender)
+			try:
+				self._mark_my_status(marker_id, sender)
+			except StorageError as e:
+				self._abort_snapshot(marker_id, "balance can't be loaded (%s)" % str(e))
+				return
 			self._send_markers(marker_id)
 
 			# 3. all incoming messages will be recorded
 		else:
-			logging.info("Status for marker '%s' already marked. Marking send %s as complete." % (marker_id, sender))
+			logging.info("Status for marker '%s' already marked. Marking send %s as complete.", marker_id, sender)
 			# token with given marker_id was already received -> my state was already marked down
 			# stop recording messages from sender
-			self._status_holder.mark_channel_as_complete(marker_id, sender)
+			self._status_holder.mark_channel_as_complete(marker_id, sender.name)
 
 		# messages from all channels recorded -> algorithm ends
 		if self._status_holder.is_status_complete(marker_id):
-			logging.info("Algorithm for marker %s is complete." % marker_id)
+			logging.info("Algorithm for marker %s is complete.", marker_id)
+			self._metrics.count("snapshots.completed")
+			self._metrics.observe("snapshot", time.perf_counter() - self._snapshot_start_times.pop(marker_id))
 			self._report_status(marker_id)
 			self._ch_l_cleanup(marker_id)
 
@@ -592,27 +2190,43 @@ class Bank:
 	def _send_credit(self, amount, target):
 		"""
 		Deducts given amount from this bank's account and sends CREDIT message to target.
+		REFUSED is sent instead if there's not enough money.
 		
-		:param Socket target: Socket to send message to.
+		:param Peer target: Peer to send message to.
 		"""
-		if self._check_amount(amount):
-			self._db_connector.debit_money(amount)
-			target.send_json(Message.credit(amount).to_dict())
-		else:
-			logging.info("Not enough funds in bank, cannot credit %s." % str(amount))
+		if not self._try_send_credit(amount, target):
+			MESSAGE_LOG.debug("Not enough funds in bank, cannot credit %s.", amount)
 			self._send_refuse(target)
 
+	def _try_send_credit(self, amount, target):
+		"""
+		Deducts given amount from this bank's account and sends CREDIT message to target
+		if there's enough money.
+
+		:param Peer target: Peer to send message to.
+		:return: True if the CREDIT message was sent.
+		"""
+		if not self._db_connector.try_debit(amount):
+			return False
+
+		target.send(Message.credit(amount))
+		self._metrics.count("messages_out.CREDIT")
+		return True
+
 	def _send_debit(self, amount, target):
 		"""
 		Sends DEBIT message for given amount to given target.
 		"""
-		target.send_json(Message.debit(amount).to_dict())
+		target.send(Message.debit(amount))
+		self._metrics.count("messages_out.DEBIT")
+		self._metrics.debit_sent(target, amount)
 
 	def _send_refuse(self, target):
 		"""
 		Sends REFUSED message to target.
 		"""
-		target.send_json(Message.refused().to_dict())
+		target.send(Message.refused())
+		self._metrics.count("messages_out.REFUSED")
 
 	def _send_markers(self, marker_id):
 		"""
@@ -623,8 +2237,9 @@ class Bank:
 		peers = self._get_available_peers()
 		for peer in peers:
 			msg = Message.marker(marker_id)
-			logging.info("Sending marker message: %s." % msg)
-			peer.send_json(msg.to_dict())
+			logging.info("Sending marker message: %s.", msg)
+			peer.send(msg)
+			self._metrics.count("messages_out.MARKER")
 
 	def _mark_my_status(self, marker_id, sender):
 		"""
@@ -633,8 +2248,14 @@ class Bank:
 		:param sender: Peer from which the marker message was received.
 		:return:
 		"""
-		self._status_holder.new_global_state(marker_id, self._db_connector.get_amount(),
-											sender, len(self._get_available_peers()))
+		# balance has to include all pending changes, otherwise the snapshot would not be consistent
+		self._db_connector.flush()
+		amount = self._db_connector.get_amount()
+		self._metrics.count("snapshots.started")
+		self._snapshot_start_times[marker_id] = time.perf_counter()
+		self._status_holder.new_global_state(marker_id, amount,
+											sender.name if sender is not None else None,
+											[peer.name for peer in self._get_available_peers()])
 
 	def _report_status(self, marker_id):
 		"""
@@ -644,20 +2265,11 @@ class Bank:
 		:param int marker_id: Id of snapshot to report.
 		:return:
 		"""
-		local_state = self._status_holder.get_state(marker_id).to_dict()
-		local_state["bank_id"] = self._bank_id
-		local_state["marker_id"] = marker_id
-		logging.info("Reporting local state (%s) for marker %s." % (str(local_state), marker_id))
-		self._collector_socket.send_json(local_state)
-
-	def _is_my_socket_that_is_not_ready(self, socket):
-		"""
-		Checks if the given socket is 'my socket' (the one the bank is listening on) that is not ready yet.
-
-		:param socket:
-		:return:
-		"""
-		return socket in self._my_sockets and not self._sockets_ready[socket]
+		report = self._reporter.report(marker_id, self._status_holder.get_state(marker_id).to_dict())
+		report["bank_id"] = self._bank_id
+		report["marker_id"] = marker_id
+		logging.info("Reporting local state (%s) for marker %s.", report, marker_id)
+		self._collector_socket.send_json(report)
 
 	def _check_marker_file(self):
 		"""
@@ -668,28 +2280,103 @@ class Bank:
 
 		marker_filename = "MARKER"
 
-		if os.path.isfile(marker_filename) and not self._ch_l_running:
-			logging.info("'%s' file detected, starting CH-L with id %s." % (marker_filename, self._bank_id))
+		if os.path.isfile(marker_filename):
 			os.remove(marker_filename)
-			self._ch_l_running = True
-			self._handle_global_state(Message.marker(self._bank_id), None)
+			self._start_snapshot()
+
+	def _schedule_snapshots(self, interval):
+		"""
+		Starts periodic snapshots with given interval, previous schedule is cancelled.
+
+		:param float interval: Interval in seconds, None stops periodic snapshots.
+		"""
+		if interval is not None and interval <= 0:
+			raise ValueError("Snapshot interval has to be positive.")
+
+		self._snapshot_interval = interval
+		self._snapshot_schedule += 1
+		if interval is not None:
+			logging.info("Starting snapshot every %s s.", interval)
+			schedule = self._snapshot_schedule
+			self._scheduler.call_later(interval, lambda: self._on_snapshot_timer(schedule))
+
+	def _on_snapshot_timer(self, schedule):
+		if schedule != self._snapshot_schedule:
+			# schedule was changed
+			return
+
+		self._start_snapshot()
+		self._scheduler.call_later(self._snapshot_interval, lambda: self._on_snapshot_timer(schedule))
+
+	def _new_marker_id(self):
+		"""
+		Creates unique marker id from current time (in ms) and id of this bank, so
+		snapshots started by different banks (or one bank repeatedly) never collide.
+		"""
+		now = max(int(time.time() * 1000), self._last_marker_time + 1)
+		self._last_marker_time = now
+		return (now << 16) | self._marker_bank_bits
+
+	def _start_snapshot(self):
+		"""
+		Starts new CH-L algorithm initiated by this bank.
+
+		:return: Marker id of the new snapshot.
+		"""
+		marker_id = self._new_marker_id()
+		logging.info("Starting CH-L with id %s.", marker_id)
+		self._metrics.snapshot_started(marker_id)
+		self._handle_global_state(Message.marker(marker_id), None)
+		return marker_id
+
+	def _expire_snapshots(self):
+		"""
+		Aborts snapshots which are running for too long (e.g. because a marker was lost).
+		"""
+		for marker_id in self._status_holder.expired_markers(self._snapshot_timeout):
+			self._abort_snapshot(marker_id, "timeout")
+
+	def _abort_snapshot(self, marker_id, reason):
+		"""
+		Drops local state of unfinished snapshot and reports the abort to the state collector.
+
+		:param int marker_id: Id of the snapshot.
+		:param str reason: Why the snapshot is aborted.
+		"""
+		logging.warning("Aborting snapshot %s: %s.", marker_id, reason)
+		self._metrics.count("snapshots.aborted")
+		self._snapshot_start_times.pop(marker_id, None)
+		self._collector_socket.send_json(dict(bank_id=self._bank_id, marker_id=marker_id, aborted=reason))
+		self._ch_l_cleanup(marker_id)
 
 	def _ch_l_cleanup(self, marker_id):
 		"""
-		Cleanup after chandy lamport algorithm. If the marker id is same
-		as id of this bank, ch_l_running flag is set to False.
+		Cleanup after chandy lamport algorithm.
 
-		:param str marker_id: Marker ID.
+		:param int marker_id: Marker ID.
 		:return:
 		"""
 		self._status_holder.clear_state(marker_id)
-		if marker_id == self._bank_id:
-			self._ch_l_running = False
+
+
+def to_endpoint(address, bind=False):
+	"""
+	Converts address from configuration to ZeroMQ endpoint. Address is either a port
+	to bind to, <host>:<port> to connect to or full endpoint (e.g. ipc://bank-1.ipc).
+
+	:param str address: Address from configuration.
+	:param bool bind: Whether the address is used for binding.
+	:return: ZeroMQ endpoint.
+	"""
+	if "://" in address:
+		return address
+	return "tcp://*:%s" % address if bind else "tcp://%s" % address
 
 
 def load_configuration(bank_id):
 	"""
-	Loads configuration of bank addresses and state collector address.
+	Loads configuration of bank addresses and state collector address. Collector
+	address of bank which isn't listed in state-collector.csv is taken from '*' line.
 
 	:param string bank_id: Id of bank to load configuration for.
 
@@ -702,11 +2389,11 @@ def load_configuration(bank_id):
 
 	res = None
 	if not os.path.isfile(bank_addr_file):
-		logging.error("Configuration file '%s' with bank addresses not found." % bank_addr_file)
+		logging.error("Configuration file '%s' with bank addresses not found.", bank_addr_file)
 		return res
 
 	if not os.path.isfile(state_collect_file):
-		logging.error("Configuration file '%s' with state collector not found." % state_collect_file)
+		logging.error("Configuration file '%s' with state collector not found.", state_collect_file)
 		return res
 
 	res = dict()
@@ -733,60 +2420,210 @@ def load_configuration(bank_id):
 				bank_conf[items[0]]["other_banks"] = items[1:]
 
 	res["bank_conf"] = bank_conf[bank_id] if bank_id in bank_conf else dict(ports=[], other_banks=[])
-	res["state_collector"] = state_collector_conf[bank_id]
+	res["state_collector"] = state_collector_conf.get(bank_id, state_collector_conf.get("*"))
+	if res["state_collector"] is None:
+		logging.error("No state collector configured for bank %s in '%s'.", bank_id, state_collect_file)
+		return None
 	logging.info("Configuration for bank %s: %s.", bank_id, str(res))
 
 	return res
 
 
-def load_bank_id():
+def load_arguments():
 	"""
-	Bank id is expected to be the first console argument.
+	Parses console arguments. Bank id is expected to be the first console argument,
+	the rest are optional tuning switches.
 
-	:return: Id of this bank or None if none was passed.
+	:return: Parsed arguments or None if they are not valid.
 	"""
-	if (len(sys.argv)) != 2:
-		logging.error("Wrong number of arguments, expected just one, got: %s.", str(sys.argv))
+	parser = argparse.ArgumentParser(description="KIV/DS bank server.")
+	parser.add_argument("bank_id", help="Id of this bank.")
+	parser.add_argument("--group-commit-size", type=int, default=1,
+						help="Max number of balance updates merged into one DB commit (1 = no group commit).")
+	parser.add_argument("--group-commit-interval", type=int, default=50,
+						help="Max time in ms pending balance updates can wait for commit.")
+	parser.add_argument("--cache-balance", action="store_true",
+						help="Keep balance in memory instead of querying DB on every check.")
+	parser.add_argument("--wire-format", choices=["binary", "json"], default="binary",
+						help="Preferred wire format of messages sent to other banks.")
+	parser.add_argument("--batch-size", type=int, default=1,
+						help="Max number of messages sent to peer in one batch (1 = no batching).")
+	parser.add_argument("--batch-timeout", type=int, default=5,
+						help="Max time in ms message can wait for batch to be sent.")
+	parser.add_argument("--topology", choices=[TOPOLOGY_PAIR, TOPOLOGY_ROUTER], default=TOPOLOGY_PAIR,
+						help="Socket topology: PAIR socket per neighbour or one ROUTER socket for all of them.")
+	parser.add_argument("--collector-socket", choices=[COLLECTOR_PAIR, COLLECTOR_PUSH], default=COLLECTOR_PAIR,
+						help="Socket reporting to the state collector, use push with collector in pull mode.")
+	parser.add_argument("--handshake-timeout", type=float, default=1.0,
+						help="Time (in seconds) to wait for handshake response before it's retried.")
+	parser.add_argument("--handshake-max-backoff", type=float, default=30.0,
+						help="Max time (in seconds) to wait for handshake response, timeout doubles with every retry.")
+	parser.add_argument("--send-hwm", type=int, default=1000,
+						help="Send high-water mark (in batches) of sockets to other banks.")
+	parser.add_argument("--recv-hwm", type=int, default=1000,
+						help="Receive high-water mark (in batches) of sockets to other banks.")
+	parser.add_argument("--max-backlog", type=int, default=10000,
+						help="Number of unsent messages after which no new messages are generated for the peer.")
+	parser.add_argument("--recv-budget", type=int, default=64,
+						help="Max number of batches received from one socket per poll.")
+	parser.add_argument("--rate", type=float, default=20.0,
+						help="Number of generated messages per second (0 = no generation).")
+	parser.add_argument("--arrivals", choices=LoadGenerator.ARRIVALS, default="poisson",
+						help="Distribution of message arrivals.")
+	parser.add_argument("--amounts", choices=LoadGenerator.AMOUNTS, default="uniform",
+						help="Distribution of message amounts.")
+	parser.add_argument("--min-amount", type=int, default=10000, help="Min amount of money in generated message.")
+	parser.add_argument("--max-amount", type=int, default=50000, help="Max amount of money in generated message.")
+	parser.add_argument("--seed", type=int, default=None, help="Seed of the load generator RNG.")
+	parser.add_argument("--stats-file", default=None,
+						help="File to write metrics (JSON) to when the bank stops.")
+	parser.add_argument("--control-port", default=None,
+						help="Port of control endpoint (ZeroMQ REP socket) serving metrics and snapshot commands.")
+	parser.add_argument("--no-marker-file", action="store_true",
+						help="Don't check MARKER file, snapshots are started via control endpoint or periodically.")
+	parser.add_argument("--snapshot-interval", type=float, default=None,
+						help="Start snapshot periodically (interval in seconds).")
+	parser.add_argument("--snapshot-timeout", type=float, default=30.0,
+						help="Time (in seconds) after which unfinished snapshot is aborted.")
+	parser.add_argument("--max-snapshots", type=int, default=16,
+						help="Max number of snapshots taken at a time.")
+	parser.add_argument("--snapshot-max-messages", type=int, default=100000,
+						help="Max number of channel messages recorded by one snapshot (full channel report only).")
+	parser.add_argument("--channel-report", default=CHANNEL_REPORT_SUMMARY,
+						choices=[CHANNEL_REPORT_SUMMARY, CHANNEL_REPORT_HISTOGRAM, CHANNEL_REPORT_FULL],
+						help="Report recorded channel state as summary (count and sum of CREDITs), summary with "
+							 "histogram of CREDIT amounts or full list of messages.")
+	parser.add_argument("--delta-reports", action="store_true",
+						help="Report differences against the previous snapshot (summary and histogram channel reports).")
+	parser.add_argument("--full-report-every", type=int, default=10,
+						help="With delta reports, every n-th report is full.")
+	parser.add_argument("--log-level", default="INFO",
+						help="Log level (DEBUG, INFO, WARNING, ...), can be changed at runtime via control endpoint.")
+	parser.add_argument("--message-log-rate", type=int, default=100,
+						help="Max number of per-message log records per second (logger 'bank.messages'), 0 for unlimited.")
+	parser.add_argument("--storage", choices=["mysql", "sqlite", "memory"], default="mysql",
+						help="Storage backend of the bank account.")
+	parser.add_argument("--sqlite-path", default="bank.db",
+						help="SQLite DB file, use ':memory:' for in-memory SQLite DB.")
+	parser.add_argument("--initial-balance", type=int, default=5000000,
+						help="Initial balance of newly created account (sqlite and memory storage).")
+	parser.add_argument("--db-host", default="localhost", help="MySQL host.")
+	parser.add_argument("--db-user", default="root", help="MySQL user.")
+	parser.add_argument("--db-password", default="r00t", help="MySQL password.")
+	parser.add_argument("--db-schema", default="bank_server", help="MySQL schema.")
+	parser.add_argument("--db-health-check-interval", type=int, default=30,
+						help="Idle time in seconds after which MySQL connection is checked before use.")
+	parser.add_argument("--db-max-reconnect-backoff", type=float, default=30.0,
+						help="Max time in seconds between attempts to connect to unavailable MySQL.")
+
+	try:
+		return parser.parse_args()
+	except SystemExit:
+		logging.error("Wrong arguments: %s.", str(sys.argv))
 		return None
+
+
+def create_storage_backend(arguments):
+	"""
+	Creates storage backend selected by console arguments.
+
+	:return: StorageBackend instance.
+	"""
+	logging.info("Using '%s' storage.", arguments.storage)
+	if arguments.storage == "sqlite":
+		return SqliteBackend(path=arguments.sqlite_path, initial_balance=arguments.initial_balance)
+	elif arguments.storage == "memory":
+		return InMemoryBackend(initial_balance=arguments.initial_balance)
 	else:
-		return sys.argv[1]
+		return MySqlBackend(host=arguments.db_host,
+							user=arguments.db_user,
+							password=arguments.db_password,
+							schema=arguments.db_schema,
+							health_check_interval=arguments.db_health_check_interval,
+							max_reconnect_backoff=arguments.db_max_reconnect_backoff)
+
 
+def configure_logging(include_console=False, message_log_rate=100):
+	"""
+	Configures logging to log.txt (and console). Records are passed through queue to background
+	thread which formats and writes them.
 
-def configure_logging(include_console=False):
+	:param bool include_console: Log to console too.
+	:param int message_log_rate: Max number of per-message records logged per second, 0 for unlimited.
+	"""
 	if os.path.isfile("log.txt"):
 		os.remove("log.txt")
 
-	logging.basicConfig(filename='log.txt',
-						filemode='a',
-						format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-						datefmt='%H:%M:%S',
-						level=logging.DEBUG)
-
+	formatter = logging.Formatter('%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s', datefmt='%H:%M:%S')
+	handlers = [logging.FileHandler('log.txt', mode='a')]
 	if include_console:
-		console = logging.StreamHandler()
-		console.setLevel(logging.DEBUG)
-		logging.getLogger('').addHandler(console)
+		handlers.append(logging.StreamHandler())
+	for handler in handlers:
+		handler.setFormatter(formatter)
+
+	log_queue = queue.Queue()
+	listener = logging.handlers.QueueListener(log_queue, *handlers)
+	listener.start()
+	# write remaining records before exit
+	atexit.register(listener.stop)
+
+	root = logging.getLogger('')
+	root.addHandler(DeferredQueueHandler(log_queue))
+	root.setLevel(logging.INFO)
+
+	if message_log_rate > 0:
+		MESSAGE_LOG.addFilter(RateLimitFilter(message_log_rate))
+
+	return listener
+
+
+def set_log_level(level, logger_name=None):
+	"""
+	Sets level of given logger.
+
+	:param str level: Name of the level (DEBUG, INFO, ...).
+	:param str logger_name: Name of the logger, root logger is used if not set.
+	:raise ValueError: If the level is unknown or the logger name isn't a string.
+	"""
+	if not isinstance(logging.getLevelName(str(level).upper()), int):
+		raise ValueError("Unknown log level: %s." % level)
+	if logger_name is not None and not isinstance(logger_name, str):
+		raise ValueError("Logger name has to be a string: %s." % str(logger_name))
+	logging.getLogger(logger_name).setLevel(str(level).upper())
 
 
 def main():
 	"""
 	Main method of the script, starts the server.
 	"""
-	configure_logging(True)
-
-	bank_id = load_bank_id()
-	if bank_id is None:
+	arguments = load_arguments()
+	if arguments is None:
 		return
+	bank_id = arguments.bank_id
+
+	configure_logging(True, arguments.message_log_rate)
+	set_log_level(arguments.log_level)
 
 	configuration = load_configuration(bank_id)
 	if configuration is None:
 		exit(1)
 
-	logging.info("Bank '%s' starting" % bank_id)
-	db_connector = DbConnector()
+	logging.info("Bank '%s' starting", bank_id)
+	try:
+		backend = create_storage_backend(arguments)
+	except RuntimeError as e:
+		logging.error("Storage can't be created: %s", e)
+		exit(1)
+
+	metrics = Metrics()
+	db_connector = DbConnector(backend,
+							   group_commit_size=arguments.group_commit_size,
+							   group_commit_interval=arguments.group_commit_interval / 1000.0,
+							   cache_balance=arguments.cache_balance,
+							   metrics=metrics)
 	amount = db_connector.get_amount()
 	if amount is not None:
-		logging.info("Original balance: %s" % str(amount))
+		logging.info("Original balance: %s", amount)
 	else:
 		logging.warning("No original amount.")
 
@@ -796,10 +2633,44 @@ def main():
 				debug=True,
 				db_connector=db_connector,
 				other_banks=configuration["bank_conf"]["other_banks"],
-				state_collector=configuration["state_collector"])
+				state_collector=configuration["state_collector"],
+				wire_format=WIRE_BINARY if arguments.wire_format == "binary" else WIRE_JSON,
+				batch_size=arguments.batch_size,
+				batch_timeout=arguments.batch_timeout / 1000.0,
+				topology=arguments.topology,
+				recv_budget=arguments.recv_budget,
+				load_generator=LoadGenerator(rate=arguments.rate,
+											 arrivals=arguments.arrivals,
+											 amounts=arguments.amounts,
+											 min_amount=arguments.min_amount,
+											 max_amount=arguments.max_amount,
+											 seed=arguments.seed),
+				stats_file=arguments.stats_file,
+				metrics=metrics,
+				control_port=arguments.control_port,
+				snapshot_timeout=arguments.snapshot_timeout,
+				max_snapshots=arguments.max_snapshots,
+				snapshot_max_messages=arguments.snapshot_max_messages,
+				collector_socket=arguments.collector_socket,
+				marker_file=not arguments.no_marker_file,
+				snapshot_interval=arguments.snapshot_interval,
+				channel_report=arguments.channel_report,
+				delta_reports=arguments.delta_reports,
+				full_report_every=arguments.full_report_every,
+				handshake_timeout=arguments.handshake_timeout,
+				handshake_max_backoff=arguments.handshake_max_backoff,
+				send_hwm=arguments.send_hwm,
+				recv_hwm=arguments.recv_hwm,
+				max_backlog=arguments.max_backlog)
+	signal.signal(signal.SIGTERM, lambda signum, frame: bank.stop())
 	bank.start_server()
+	try:
+		db_connector.verify_balance()
+	except StorageError as e:
+		logging.error("Balance can't be verified: %s", e)
 	db_connector.close_connection()
 
 
 # Script body
-main()
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,300 @@
+#
+# Benchmark of transfer throughput and snapshot latency. For every combination of bank count,
+# topology and storage backend a local cluster is started (see cluster.py), loaded for a given time
+# while snapshots are triggered, and then measured using statistics written by banks and the
+# state collector. Results are written as JSON so they can be compared between runs.
+#
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from cluster import ClusterLayout, LocalCluster, generate_edges, TOPOLOGIES
+
+BANK_STATS_FILE = "stats.json"
+COLLECTOR_STATS_FILE = "reports.jsonl"
+
+
+def percentiles(samples, points=(50, 90, 99)):
+	"""
+	Computes percentiles (nearest rank) of given samples.
+
+	:return: Dict with p<point> keys, max and count or None if there are no samples.
+	"""
+	if len(samples) == 0:
+		return None
+
+	ordered = sorted(samples)
+	res = dict(("p%d" % p, ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]) for p in points)
+	res["max"] = ordered[-1]
+	res["count"] = len(ordered)
+	return res
+
+
+def histogram_percentiles(buckets, points=(50, 90, 99)):
+	"""
+	Computes percentiles of histogram written by banks. Percentile is the upper bound of
+	the bucket containing it.
+
+	:param dict buckets: Upper bound of bucket -> count.
+	:return: Dict with p<point> keys, max and count or None if the histogram is empty.
+	"""
+	count = sum(buckets.values())
+	if count == 0:
+		return None
+
+	ordered = sorted(buckets.items())
+	res = dict()
+	for p in points:
+		rank = max(1, int(count * p / 100.0 + 0.5))
+		seen = 0
+		for bound, n in ordered:
+			seen += n
+			if seen >= rank:
+				res["p%d" % p] = bound
+				break
+	res["max"] = ordered[-1][0]
+	res["count"] = count
+	return res
+
+
+def load_bank_stats(cluster):
+	"""
+	Loads stats files of all banks.
+
+	:return: Dict bank id -> stats, banks which haven't written their stats are missing.
+	"""
+	stats = dict()
+	for bank_id in cluster.layout.bank_ids:
+		file_name = os.path.join(cluster.bank_dir(bank_id), BANK_STATS_FILE)
+		if os.path.isfile(file_name):
+			with open(file_name, "r") as f:
+				stats[bank_id] = json.load(f)
+		else:
+			logging.warning("Bank %s hasn't written its statistics." % bank_id)
+	return stats
+
+
+def request_bank_stats(cluster):
+	"""
+	Requests current statistics of all banks over their control endpoints.
+
+	:return: Dict bank id -> stats, banks which haven't responded are missing.
+	"""
+	stats = dict()
+	for bank_id in cluster.layout.bank_ids:
+		response = cluster.control_request(bank_id, dict(command="stats"))
+		if response is not None and "error" not in response:
+			stats[bank_id] = response
+		else:
+			logging.warning("Bank %s hasn't sent its statistics.", bank_id)
+	return stats
+
+
+def subtract_stats(stats, baseline):
+	"""
+	Computes statistics of the window between baseline and stats, so that warmup traffic isn't counted.
+
+	:param dict stats: Final statistics of a bank.
+	:param dict baseline: Statistics of the same bank taken at the start of measurement.
+	:return: Dict with run_time, counters and histograms (buckets and count) of the window.
+	"""
+	counters = dict()
+	for name, value in stats["counters"].items():
+		counters[name] = value - baseline["counters"].get(name, 0)
+
+	histograms = dict()
+	for name, histogram in stats["histograms"].items():
+		base = baseline["histograms"].get(name, dict(count=0, buckets=[]))
+		base_buckets = dict((bound, n) for bound, n in base["buckets"])
+		buckets = [[bound, n - base_buckets.get(bound, 0)] for bound, n in histogram["buckets"]]
+		histograms[name] = dict(
+			count=histogram["count"] - base["count"],
+			buckets=[bucket for bucket in buckets if bucket[1] > 0]
+		)
+
+	return dict(
+		run_time=stats["run_time"] - baseline["run_time"],
+		counters=counters,
+		histograms=histograms,
+		snapshots=stats["snapshots"]
+	)
+
+
+def load_report_arrivals(cluster):
+	"""
+	Loads arrival times of local state reports recorded by the state collector.
+	"""
+	file_name = os.path.join(cluster.collector_dir(), COLLECTOR_STATS_FILE)
+	if not os.path.isfile(file_name):
+		return []
+
+	with open(file_name, "r") as f:
+		return [json.loads(line) for line in f.readlines() if line.strip() != ""]
+
+
+def evaluate_transfers(bank_stats):
+	"""
+	Computes transfer throughput, DEBIT round trip latency and DB operations per transfer.
+
+	:param dict bank_stats: Bank id -> statistics of the measured window (see subtract_stats).
+	"""
+	counters = dict()
+	run_time = 0.0
+	round_trips = dict()
+	db_queries = 0
+	for stats in bank_stats.values():
+		for name, value in stats["counters"].items():
+			counters[name] = counters.get(name, 0) + value
+		run_time = max(run_time, stats["run_time"])
+
+		histograms = stats["histograms"]
+		for bound, n in histograms.get("debit_round_trip", dict(buckets=[]))["buckets"]:
+			round_trips[bound] = round_trips.get(bound, 0) + n
+		db_queries += histograms.get("db_query", dict(count=0))["count"]
+
+	credits = counters.get("messages_out.CREDIT", 0)
+	debits = counters.get("messages_out.DEBIT", 0)
+	return dict(
+		messages_per_second=(credits + debits) / run_time if run_time > 0 else 0.0,
+		credits_per_second=credits / run_time if run_time > 0 else 0.0,
+		measured_time=run_time,
+		debit_round_trip_ms=histogram_percentiles(round_trips),
+		db_operations_per_transfer=db_queries / float(credits) if credits > 0 else None,
+		counters=counters
+	)
+
+
+def evaluate_snapshots(bank_stats, reports, bank_count):
+	"""
+	Computes time from start of every snapshot to arrival of the last local state report at the collector.
+	"""
+	latencies = []
+	incomplete = 0
+	for stats in bank_stats.values():
+		for snapshot in stats["snapshots"]:
+			arrivals = dict()
+			for report in reports:
+				if report["marker_id"] == snapshot["marker_id"] and report["time"] >= snapshot["time"] \
+						and report["bank_id"] not in arrivals:
+					arrivals[report["bank_id"]] = report["time"]
+
+			if len(arrivals) < bank_count:
+				incomplete += 1
+			else:
+				latencies.append((max(arrivals.values()) - snapshot["time"]) * 1000.0)
+
+	return dict(
+		latency_ms=percentiles(latencies),
+		incomplete=incomplete
+	)
+
+
+def run_benchmark(bank_count, topology, storage, arguments, bank_args, base_port):
+	"""
+	Runs one benchmark. Every benchmark uses new ports, so sockets of the previous
+	cluster can't interfere.
+
+	:param int base_port: First TCP port to use.
+	:return: Tuple (dict with results, first unused port).
+	"""
+	logging.info("Benchmark: %d banks, %s topology, %s storage." % (bank_count, topology, storage))
+	bank_ids = [str(i) for i in range(1, bank_count + 1)]
+	layout = ClusterLayout(bank_ids, generate_edges(bank_count, topology, arguments.degree, arguments.seed),
+						   socket_topology=arguments.socket_topology,
+						   transport=arguments.transport,
+						   base_port=base_port,
+						   ipc_dir=arguments.work_dir,
+						   collector_socket=arguments.collector_socket)
+	cluster = LocalCluster(layout, arguments.work_dir, storage,
+						   bank_args + ["--stats-file", BANK_STATS_FILE],
+						   ["--stats-file", COLLECTOR_STATS_FILE])
+	cluster.start()
+	ready_time = cluster.wait_until_ready()
+
+	time.sleep(arguments.warmup)
+	baseline = request_bank_stats(cluster)
+	interval = arguments.duration / (arguments.snapshots + 1)
+	for _ in range(arguments.snapshots):
+		time.sleep(interval)
+		cluster.trigger_snapshot(bank_ids[0])
+	time.sleep(interval)
+
+	healthy = cluster.is_running()
+	cluster.stop()
+
+	bank_stats = load_bank_stats(cluster)
+	measured = dict((bank_id, subtract_stats(stats, baseline[bank_id]))
+					for bank_id, stats in bank_stats.items() if bank_id in baseline)
+	return (dict(
+		banks=bank_count,
+		topology=topology,
+		socket_topology=arguments.socket_topology,
+		collector_socket=arguments.collector_socket,
+		storage=storage,
+		healthy=healthy and len(measured) == bank_count and ready_time is not None,
+		ready_time=ready_time,
+		transfers=evaluate_transfers(measured),
+		snapshots=evaluate_snapshots(bank_stats, load_report_arrivals(cluster), bank_count)
+	), layout.next_port)
+
+
+def main():
+	"""
+	Main method of the script, runs all benchmarks and writes the results.
+	"""
+	logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+	parser = argparse.ArgumentParser(description="Benchmark of transfer throughput and snapshot latency.")
+	parser.add_argument("--banks", default="4", help="Comma separated bank counts.")
+	parser.add_argument("--topologies", default="ring", help="Comma separated topologies (%s)." % ", ".join(TOPOLOGIES))
+	parser.add_argument("--storages", default="memory", help="Comma separated storage backends (memory, sqlite).")
+	parser.add_argument("--degree", type=int, default=3, help="Average number of neighbours in random topology.")
+	parser.add_argument("--seed", type=int, default=1, help="Seed of random topology.")
+	parser.add_argument("--socket-topology", choices=["pair", "router"], default="pair",
+						help="Socket topology of banks.")
+	parser.add_argument("--collector-socket", choices=["pair", "push"], default="pair",
+						help="Socket banks report to the state collector with.")
+	parser.add_argument("--transport", choices=["tcp", "ipc"], default="tcp", help="ZeroMQ transport.")
+	parser.add_argument("--base-port", type=int, default=20000, help="First TCP port used by the cluster.")
+	parser.add_argument("--warmup", type=float, default=2.0, help="Time (in seconds) between all banks being ready and start of measurement, "
+						"transfers during it aren't counted.")
+	parser.add_argument("--duration", type=float, default=10.0, help="Duration (in seconds) of one benchmark.")
+	parser.add_argument("--snapshots", type=int, default=3, help="Number of snapshots triggered in one benchmark.")
+	parser.add_argument("--work-dir", default="benchmark-run", help="Working directory of clusters.")
+	parser.add_argument("--output", default=None, help="Output file, results are printed if not set.")
+	parser.add_argument("bank_args", nargs=argparse.REMAINDER, help="Additional bank arguments (after '--').")
+	arguments = parser.parse_args()
+
+	bank_args = [a for a in arguments.bank_args if a != "--"]
+	results = []
+	base_port = arguments.base_port
+	for storage in arguments.storages.split(","):
+		for topology in arguments.topologies.split(","):
+			for bank_count in [int(b) for b in arguments.banks.split(",")]:
+				result, base_port = run_benchmark(bank_count, topology, storage, arguments, bank_args, base_port)
+				results.append(result)
+
+	output = dict(
+		parameters=dict(
+			warmup=arguments.warmup,
+			duration=arguments.duration,
+			snapshots=arguments.snapshots,
+			transport=arguments.transport,
+			bank_args=bank_args
+		),
+		results=results
+	)
+	if arguments.output is None:
+		json.dump(output, sys.stdout, indent=2)
+		sys.stdout.write("\n")
+	else:
+		with open(arguments.output, "w") as f:
+			json.dump(output, f, indent=2)
+		logging.info("Results written to %s." % arguments.output)
+
+
+if __name__ == "__main__":
+	main()
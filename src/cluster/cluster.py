@@ -0,0 +1,447 @@
+#
+# This script runs the whole system (banks + state collector) as local processes on one machine.
+# Topology of banks is either loaded from bank-addrs.csv (hosts are mapped to banks using the
+# Vagrantfile) or generated (ring, mesh or random graph of N banks). Banks communicate
+# over tcp://127.0.0.1 or ipc:// and use in-memory or SQLite storage, so no VM or MySQL is needed.
+#
+import argparse
+import logging
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+import zmq
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BANK_SCRIPT = os.path.join(SRC_DIR, "bank", "bank.py")
+COLLECTOR_SCRIPT = os.path.join(SRC_DIR, "state-collector", "state-collector.py")
+
+TOPOLOGIES = ["ring", "mesh", "random"]
+
+
+def generate_edges(bank_count, topology, degree=3, seed=None):
+	"""
+	Generates connections between banks 1..bank_count. Bank with higher id always connects
+	to the bank with lower id (same as in bank-addrs.csv).
+
+	:param int bank_count: Number of banks.
+	:param str topology: One of TOPOLOGIES.
+	:param int degree: Average number of neighbours of a bank in random topology.
+	:param seed: Seed for random topology.
+	:return: Sorted list of (listening bank, connecting bank) tuples.
+	"""
+	edges = set()
+	if topology == "mesh":
+		for i in range(1, bank_count + 1):
+			for j in range(i + 1, bank_count + 1):
+				edges.add((i, j))
+
+	elif topology == "ring":
+		for i in range(1, bank_count):
+			edges.add((i, i + 1))
+		if bank_count > 2:
+			edges.add((1, bank_count))
+
+	else:
+		rng = random.Random(seed)
+
+		# random spanning tree makes sure every bank is reachable
+		for i in range(2, bank_count + 1):
+			edges.add((rng.randint(1, i - 1), i))
+
+		max_edges = bank_count * (bank_count - 1) // 2
+		wanted_edges = min(max_edges, bank_count * degree // 2)
+		while len(edges) < wanted_edges:
+			a, b = rng.sample(range(1, bank_count + 1), 2)
+			edges.add((min(a, b), max(a, b)))
+
+	return [(str(a), str(b)) for a, b in sorted(edges)]
+
+
+def load_vagrant_hosts(vagrantfile):
+	"""
+	Loads IP address of every bank from Vagrantfile.
+
+	:return: Dict ip -> bank id.
+	"""
+	hosts = dict()
+	with open(vagrantfile, "r") as f:
+		for line in f.readlines():
+			m = re.search(r':ip\s*=>\s*"([^"]+)".*:bankId\s*=>\s*\'([^\']+)\'', line)
+			if m is not None:
+				hosts[m.group(1)] = m.group(2)
+	return hosts
+
+
+def load_edges_from_csv(bank_addr_file, vagrantfile):
+	"""
+	Loads connections between banks from bank-addrs.csv. Each bank has (optional) line with ports
+	followed by line with addresses it connects to.
+
+	:return: List of bank ids and list of (listening bank, connecting bank) tuples.
+	"""
+	hosts = load_vagrant_hosts(vagrantfile)
+	bank_ids = []
+	edges = []
+	with open(bank_addr_file, "r") as f:
+		for line in f.readlines():
+			items = line.rstrip().split(',')
+			if items[0] == "":
+				continue
+
+			if items[0] not in bank_ids:
+				bank_ids.append(items[0])
+				continue
+
+			for address in items[1:]:
+				host = address.split(':')[0]
+				if host not in hosts:
+					raise ValueError("Host %s is not a bank in %s." % (host, vagrantfile))
+				edges.append((hosts[host], items[0]))
+
+	return bank_ids, edges
+
+
+class ClusterLayout:
+	"""
+	Addresses of all banks and the state collector. In PAIR topology listening bank
+	gets one address per neighbour, in ROUTER topology one address for all of them.
+	The state collector listens on one address per bank, or on one shared address
+	if banks report via PUSH sockets.
+	"""
+
+	def __init__(self, bank_ids, edges, socket_topology="pair", transport="tcp", base_port=20000, ipc_dir=".",
+				 collector_socket="pair"):
+		"""
+		:param list bank_ids: Ids of all banks.
+		:param list edges: List of (listening bank, connecting bank) tuples.
+		:param str socket_topology: 'pair' or 'router' (see bank.py).
+		:param str transport: 'tcp' (127.0.0.1) or 'ipc'.
+		:param int base_port: First TCP port to use.
+		:param str ipc_dir: Directory for ipc endpoints.
+		:param str collector_socket: 'pair' or 'push' (see bank.py).
+		"""
+		self.bank_ids = bank_ids
+		self.edges = edges
+		self.socket_topology = socket_topology
+		self.collector_socket = collector_socket
+		self._transport = transport
+		self.next_port = base_port
+		self._ipc_dir = os.path.abspath(ipc_dir)
+
+		# bank id -> list of addresses to bind to / connect to
+		self.listen = dict((bank_id, []) for bank_id in bank_ids)
+		self.connect = dict((bank_id, []) for bank_id in bank_ids)
+
+		# bank id (or '*' for all banks) -> (bind address, connect address) of the state collector
+		self.collector = dict()
+
+		# bank id -> (bind address, connect address) of bank's control endpoint
+		self.control = dict()
+
+		router_addresses = dict()
+		for listener, connector in edges:
+			if socket_topology == "router":
+				if listener not in router_addresses:
+					router_addresses[listener] = self._new_address("bank-%s" % listener)
+					self.listen[listener].append(router_addresses[listener][0])
+				self.connect[connector].append(router_addresses[listener][1])
+			else:
+				bind, connect = self._new_address("bank-%s-%s" % (listener, connector))
+				self.listen[listener].append(bind)
+				self.connect[connector].append(connect)
+
+		for bank_id in bank_ids:
+			self.control[bank_id] = self._new_address("control-%s" % bank_id)
+
+		if collector_socket == "push":
+			self.collector["*"] = self._new_address("collector")
+		else:
+			for bank_id in bank_ids:
+				self.collector[bank_id] = self._new_address("collector-%s" % bank_id)
+
+	def _new_address(self, name):
+		"""
+		Allocates new address.
+
+		:return: Tuple (address to bind to, address to connect to).
+		"""
+		if self._transport == "ipc":
+			endpoint = "ipc://%s/%s.ipc" % (self._ipc_dir, name)
+			return endpoint, endpoint
+
+		port = self.next_port
+		self.next_port += 1
+		return str(port), "127.0.0.1:%d" % port
+
+	def write_bank_configuration(self, directory):
+		"""
+		Writes bank-addrs.csv and state-collector.csv to given directory.
+		"""
+		with open(os.path.join(directory, "bank-addrs.csv"), "w") as f:
+			for bank_id in self.bank_ids:
+				f.write(",".join([bank_id] + self.listen[bank_id]) + "\n")
+			for bank_id in self.bank_ids:
+				f.write(",".join([bank_id] + self.connect[bank_id]) + "\n")
+
+		with open(os.path.join(directory, "state-collector.csv"), "w") as f:
+			for bank_id, address in self.collector.items():
+				f.write("%s,%s\n" % (bank_id, address[1]))
+
+	def write_collector_configuration(self, directory):
+		"""
+		Writes collector.txt to given directory.
+		"""
+		with open(os.path.join(directory, "collector.txt"), "w") as f:
+			f.write("\n".join(address[0] for address in self.collector.values()))
+
+
+class LocalCluster:
+	"""
+	Runs banks and the state collector as local processes. Every process has its own
+	working directory (with configuration files, log.txt and stderr.txt) under work_dir.
+	"""
+
+	def __init__(self, layout, work_dir, storage="memory", bank_args=None, collector_args=None):
+		"""
+		:param ClusterLayout layout: Addresses of all processes.
+		:param str work_dir: Directory for working directories of processes, it's cleared on start.
+		:param str storage: Storage of banks ('memory' or 'sqlite').
+		:param list bank_args: Additional arguments of every bank.
+		:param list collector_args: Additional arguments of the state collector.
+		"""
+		self.layout = layout
+		self.work_dir = os.path.abspath(work_dir)
+		self._storage = storage
+		self._bank_args = bank_args if bank_args is not None else []
+		self._collector_args = collector_args if collector_args is not None else []
+		self._collector = None
+		self._banks = dict()
+
+	def bank_dir(self, bank_id):
+		return os.path.join(self.work_dir, "bank-%s" % bank_id)
+
+	def collector_dir(self):
+		return os.path.join(self.work_dir, "state-collector")
+
+	def start(self):
+		"""
+		Prepares working directories and starts the state collector and all banks.
+		"""
+		if os.path.isdir(self.work_dir):
+			shutil.rmtree(self.work_dir)
+		os.makedirs(self.collector_dir())
+
+		self.layout.write_collector_configuration(self.collector_dir())
+		logging.info("Starting state collector.")
+		collector_mode = "pull" if self.layout.collector_socket == "push" else "pair"
+		self._collector = self._start_process([COLLECTOR_SCRIPT, "--socket", collector_mode,
+											   "--banks", ",".join(self.layout.bank_ids)] + self._collector_args,
+											  self.collector_dir())
+
+		for bank_id in self.layout.bank_ids:
+			directory = self.bank_dir(bank_id)
+			os.makedirs(directory)
+			self.layout.write_bank_configuration(directory)
+			logging.info("Starting bank %s." % bank_id)
+			self._banks[bank_id] = self._start_process(
+				[BANK_SCRIPT, bank_id, "--storage", self._storage, "--topology", self.layout.socket_topology,
+				 "--collector-socket", self.layout.collector_socket, "--control-port", self.layout.control[bank_id][0],
+				 "--no-marker-file"] + self._bank_args, directory
+			)
+
+	@staticmethod
+	def _start_process(args, directory):
+		# stderr contains console log and uncaught exceptions which don't make it to log.txt
+		with open(os.path.join(directory, "stderr.txt"), "w") as stderr:
+			return subprocess.Popen([sys.executable] + args, cwd=directory,
+									stdout=subprocess.DEVNULL, stderr=stderr)
+
+	def control_request(self, bank_id, request, timeout=5.0):
+		"""
+		Sends request to control endpoint of given bank.
+
+		:param dict request: Request with 'command' field (see Bank._handle_control_request).
+		:param float timeout: Max time (in seconds) to wait for the response.
+		:return: Response (dict) or None if the bank hasn't responded in time.
+		"""
+		address = self.layout.control[bank_id][1]
+		context = zmq.Context.instance()
+		socket = context.socket(zmq.REQ)
+		socket.setsockopt(zmq.LINGER, 0)
+		socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+		try:
+			socket.connect(address if "://" in address else "tcp://%s" % address)
+			socket.send_json(request)
+			return socket.recv_json()
+		except zmq.Again:
+			logging.debug("Bank %s hasn't responded to %s." % (bank_id, request))
+			return None
+		finally:
+			socket.close()
+
+	def wait_until_ready(self, timeout=60.0):
+		"""
+		Waits until all banks have finished handshakes with their neighbours.
+
+		:param float timeout: Max time to wait (in seconds).
+		:return: Time (in seconds) it took or None if the cluster isn't ready in time.
+		"""
+		start = time.monotonic()
+		waiting = list(self.layout.bank_ids)
+		while len(waiting) > 0 and time.monotonic() - start < timeout:
+			response = self.control_request(waiting[0], dict(command="peers"), timeout=0.2)
+			if response is not None and len(response["connecting"]) == 0:
+				waiting.pop(0)
+			else:
+				time.sleep(0.05)
+
+		if len(waiting) > 0:
+			logging.warning("Banks %s aren't ready." % ", ".join(waiting))
+			return None
+
+		ready_time = time.monotonic() - start
+		logging.info("All banks ready in %.2f s." % ready_time)
+		return ready_time
+
+	def trigger_snapshot(self, bank_id):
+		"""
+		Starts Chandy-Lamport algorithm on given bank.
+
+		:return: Marker id of the snapshot or None if the bank hasn't responded.
+		"""
+		response = self.control_request(bank_id, dict(command="snapshot"))
+		if response is None:
+			logging.warning("Snapshot couldn't be triggered on bank %s." % bank_id)
+			return None
+
+		marker_id = response.get("marker_id")
+		logging.info("Snapshot %s triggered on bank %s." % (marker_id, bank_id))
+		return marker_id
+
+	def schedule_snapshots(self, bank_id, interval):
+		"""
+		Makes given bank start snapshot periodically.
+
+		:param float interval: Interval in seconds, None to stop periodic snapshots.
+		:return: True if the bank has accepted the schedule.
+		"""
+		response = self.control_request(bank_id, dict(command="schedule", interval=interval))
+		return response is not None and response.get("ok", False)
+
+	def is_running(self):
+		"""
+		Checks that all processes are still alive.
+		"""
+		processes = list(self._banks.values()) + [self._collector]
+		return all(p is not None and p.poll() is None for p in processes)
+
+	def stop(self, timeout=5.0):
+		"""
+		Terminates all processes, banks first.
+		"""
+		processes = list(self._banks.values()) + [self._collector]
+		for p in processes:
+			if p is not None and p.poll() is None:
+				p.terminate()
+
+		deadline = time.monotonic() + timeout
+		for p in processes:
+			if p is None:
+				continue
+			try:
+				p.wait(max(0.0, deadline - time.monotonic()))
+			except subprocess.TimeoutExpired:
+				logging.warning("Process %d doesn't terminate, killing it." % p.pid)
+				p.kill()
+				p.wait()
+
+
+def create_layout(arguments):
+	"""
+	Creates cluster layout from console arguments.
+	"""
+	if arguments.banks is None:
+		bank_ids, edges = load_edges_from_csv(arguments.bank_addrs, arguments.vagrantfile)
+	else:
+		bank_ids = [str(i) for i in range(1, arguments.banks + 1)]
+		edges = generate_edges(arguments.banks, arguments.topology, arguments.degree, arguments.seed)
+
+	logging.info("Cluster of %d banks with %d connections." % (len(bank_ids), len(edges)))
+	return ClusterLayout(bank_ids, edges,
+						 socket_topology=arguments.socket_topology,
+						 transport=arguments.transport,
+						 base_port=arguments.base_port,
+						 ipc_dir=arguments.work_dir,
+						 collector_socket=arguments.collector_socket)
+
+
+def create_argument_parser(description):
+	"""
+	Creates parser of console arguments describing the cluster.
+	"""
+	parser = argparse.ArgumentParser(description=description)
+	parser.add_argument("--banks", type=int, default=None,
+						help="Number of banks of generated topology. If not set, topology is loaded from bank-addrs.csv.")
+	parser.add_argument("--topology", choices=TOPOLOGIES, default="ring", help="Generated topology.")
+	parser.add_argument("--degree", type=int, default=3, help="Average number of neighbours in random topology.")
+	parser.add_argument("--seed", type=int, default=None, help="Seed of random topology.")
+	parser.add_argument("--bank-addrs", default=os.path.join(SRC_DIR, "bank", "bank-addrs.csv"),
+						help="Bank addresses to load the topology from.")
+	parser.add_argument("--vagrantfile", default=os.path.join(SRC_DIR, "Vagrantfile"),
+						help="Vagrantfile used to map IP addresses in bank-addrs.csv to banks.")
+	parser.add_argument("--socket-topology", choices=["pair", "router"], default="pair",
+						help="Socket topology of banks.")
+	parser.add_argument("--collector-socket", choices=["pair", "push"], default="pair",
+						help="Socket banks report to the state collector with.")
+	parser.add_argument("--transport", choices=["tcp", "ipc"], default="tcp", help="ZeroMQ transport.")
+	parser.add_argument("--base-port", type=int, default=20000, help="First TCP port used by the cluster.")
+	parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory", help="Storage of banks.")
+	parser.add_argument("--work-dir", default="cluster-run", help="Working directory of the cluster.")
+	return parser
+
+
+def main():
+	"""
+	Main method of the script, runs the cluster until it's interrupted or duration elapses.
+	"""
+	logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+	parser = create_argument_parser("Runs banks and the state collector as local processes.")
+	parser.add_argument("--duration", type=float, default=None, help="How long to run the cluster (in seconds).")
+	parser.add_argument("--snapshot-interval", type=float, default=None,
+						help="Make the first bank start snapshot periodically (in seconds).")
+	parser.add_argument("bank_args", nargs=argparse.REMAINDER,
+						help="Additional bank arguments (after '--').")
+	arguments = parser.parse_args()
+
+	bank_args = [a for a in arguments.bank_args if a != "--"]
+	cluster = LocalCluster(create_layout(arguments), arguments.work_dir, arguments.storage, bank_args)
+	cluster.start()
+
+	start = time.monotonic()
+	try:
+		cluster.wait_until_ready()
+		if arguments.snapshot_interval is not None \
+				and not cluster.schedule_snapshots(cluster.layout.bank_ids[0], arguments.snapshot_interval):
+			logging.error("Periodic snapshots couldn't be scheduled.")
+
+		while cluster.is_running():
+			time.sleep(0.1)
+			if arguments.duration is not None and time.monotonic() - start >= arguments.duration:
+				break
+		else:
+			logging.error("Some of the processes has exited, see logs (log.txt, stderr.txt) in %s." % cluster.work_dir)
+	except KeyboardInterrupt:
+		pass
+
+	logging.info("Stopping cluster.")
+	cluster.stop()
+
+
+if __name__ == "__main__":
+	main()
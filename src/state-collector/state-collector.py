@@ -1,98 +1,690 @@
+import argparse
+import atexit
+import json
+import mmap
+import queue
+import struct
+import sys
+import time
+from collections import OrderedDict
+
 import zmq
 import logging
+import logging.handlers
 import os
 
 
+class GlobalSnapshot:
+	"""
+	Reports of one snapshot (marker_id) received so far.
+	"""
+
+	def __init__(self, marker_id, expected_banks):
+		"""
+		:param marker_id: Id of the snapshot.
+		:param set expected_banks: Ids of banks which have to report.
+		"""
+		self.marker_id = marker_id
+		self.started = time.time()
+		self.missing = set(expected_banks)
+		self.balances = dict()
+		self.in_transit = 0
+
+	def add_report(self, message):
+		"""
+		Adds local state of one bank. Money in transit are CREDIT messages recorded on its channels,
+		report contains either summaries of channels or full lists of messages.
+		"""
+		bank_id = message["bank_id"]
+		self.missing.discard(bank_id)
+		self.balances[bank_id] = message["status"]
+		if "channel_summaries" in message:
+			for summary in message["channel_summaries"].values():
+				self.in_transit += summary["credit_sum"]
+		else:
+			for messages in message["channel_messages"].values():
+				for channel_message in messages:
+					if channel_message["type"] == "CREDIT":
+						self.in_transit += channel_message["amount"]
+
+	def is_complete(self):
+		return len(self.missing) == 0
+
+	def total(self):
+		return sum(self.balances.values()) + self.in_transit
+
+
+class ReportDecoder:
+	"""
+	Rebuilds full local state reports from delta reports (see DeltaReporter in bank.py). The last
+	full (or rebuilt) report of every bank is kept as the base for its next delta.
+	"""
+
+	def __init__(self):
+		# bank_id -> last report
+		self._last = dict()
+
+	@staticmethod
+	def _apply(base, delta, drop_zero=False):
+		"""
+		Adds (possibly nested) dict of differences to base dict.
+		"""
+		res = dict(base)
+		for key, value in delta.items():
+			if isinstance(value, dict):
+				# channels are kept even when empty, histogram buckets are not
+				res[key] = ReportDecoder._apply(res.get(key, dict()), value, drop_zero=key == "credit_histogram")
+			else:
+				res[key] = res.get(key, 0) + value
+				if drop_zero and res[key] == 0:
+					res.pop(key)
+		return res
+
+	def decode(self, message):
+		"""
+		Returns full report for given message.
+
+		:param dict message: Received message.
+		:return: Full report (other messages are returned as they are) or None if the delta's base is unknown.
+		"""
+		if "base_marker_id" not in message:
+			if "status" in message:
+				self._last[message["bank_id"]] = message
+			return message
+
+		bank_id = message["bank_id"]
+		base = self._last.get(bank_id)
+		if base is None or base["marker_id"] != message["base_marker_id"]:
+			logging.error("Base %s of delta report %s from bank %s not received, report dropped.",
+						  message["base_marker_id"], message["marker_id"], bank_id)
+			self._last.pop(bank_id, None)
+			return None
+
+		removed = set(message.get("removed_channels", []))
+		summaries = dict((c, v) for c, v in base["channel_summaries"].items() if c not in removed)
+		summaries = ReportDecoder._apply(summaries, message["channel_deltas"])
+		summaries.update(message.get("new_channels", dict()))
+		report = dict(
+			bank_id=bank_id,
+			marker_id=message["marker_id"],
+			status=base["status"] + message["status_delta"],
+			channel_summaries=summaries
+		)
+		self._last[bank_id] = report
+		return report
+
+
+class SnapshotAssembler:
+	"""
+	Groups local state reports by marker_id and assembles global snapshots. Every report is processed
+	as it arrives, so the snapshot is checked as soon as the last bank reports. Total money of every
+	complete snapshot is compared with the expected total (the total of the first complete snapshot
+	if it isn't given).
+
+	Snapshot is complete when all configured banks have reported. If no banks are configured, banks
+	which have connected (or reported) so far are expected, which is only reliable if the collector
+	was started before the banks.
+	"""
+
+	def __init__(self, expected_total=None, max_pending=1024, results_file=None, banks=None):
+		"""
+		:param int expected_total: Total money in the system, None to take it from the first complete snapshot.
+		:param int max_pending: Max number of incomplete snapshots kept, the oldest one is dropped when exceeded.
+		:param str results_file: File to append results of complete snapshots to (JSON lines), None to disable.
+		:param list banks: Ids of banks taking part in snapshots, None to expect banks which have connected.
+		"""
+		self.expected_total = expected_total
+		self._max_pending = max_pending
+		self._results_file = results_file
+
+		# ids of banks taking part in snapshots, the set grows with connected banks if it isn't configured
+		self._configured = banks is not None and len(banks) > 0
+		self._banks = set(banks) if self._configured else set()
+		if not self._configured:
+			logging.warning("Banks taking part in snapshots are not configured, expecting banks which have connected.")
+
+		# marker_id -> GlobalSnapshot, ordered from the oldest one
+		self._pending = OrderedDict()
+
+		# ids of completed and aborted snapshots (the latest max_pending ones), late reports for them are ignored
+		self._finished = OrderedDict()
+
+	def bank_connected(self, bank_id):
+		if not self._configured:
+			self._banks.add(bank_id)
+		elif bank_id not in self._banks:
+			logging.warning("Bank %s is not configured, its reports will be ignored.", bank_id)
+
+	def add_message(self, message):
+		"""
+		Processes message received from a bank.
+
+		:param dict message: Received message.
+		:return: Result (dict) if the message has completed a snapshot, None otherwise.
+		"""
+		if "status" in message:
+			return self._add_report(message)
+		elif "aborted" in message:
+			self._abort(message["marker_id"], "aborted by bank %s" % message["bank_id"])
+		elif "bank_id" in message:
+			self.bank_connected(message["bank_id"])
+		return None
+
+	def _add_report(self, message):
+		marker_id = message["marker_id"]
+		bank_id = message["bank_id"]
+		if marker_id in self._finished:
+			logging.warning("Late report from bank %s for %s snapshot %s ignored.",
+							bank_id, self._finished[marker_id], marker_id)
+			return None
+
+		if not self._configured:
+			# bank may have connected before the collector was started
+			self._banks.add(bank_id)
+		elif bank_id not in self._banks:
+			logging.warning("Report from unknown bank %s for snapshot %s ignored.", bank_id, marker_id)
+			return None
+
+		snapshot = self._pending.get(marker_id)
+		if snapshot is None:
+			if len(self._pending) >= self._max_pending:
+				self._abort(next(iter(self._pending)), "too many incomplete snapshots")
+			snapshot = GlobalSnapshot(marker_id, self._banks)
+			self._pending[marker_id] = snapshot
+
+		snapshot.add_report(message)
+		if not snapshot.is_complete():
+			return None
+
+		self._pending.pop(marker_id)
+		self._finish(marker_id, "completed")
+		return self._complete(snapshot)
+
+	def _abort(self, marker_id, reason):
+		"""
+		Drops incomplete snapshot, banks which haven't reported yet are logged.
+		"""
+		snapshot = self._pending.pop(marker_id, None)
+		if snapshot is not None:
+			logging.warning("Snapshot %s dropped (%s), missing reports from banks: %s.",
+							marker_id, reason, ", ".join(sorted(snapshot.missing)))
+		self._finish(marker_id, "aborted")
+
+	def _finish(self, marker_id, state):
+		self._finished[marker_id] = state
+		if len(self._finished) > self._max_pending:
+			self._finished.popitem(last=False)
+
+	def _complete(self, snapshot):
+		total = snapshot.total()
+		if self.expected_total is None:
+			self.expected_total = total
+
+		result = dict(
+			marker_id=snapshot.marker_id,
+			banks=len(snapshot.balances),
+			balances=sum(snapshot.balances.values()),
+			in_transit=snapshot.in_transit,
+			total=total,
+			conserved=total == self.expected_total,
+			assembly_time=time.time() - snapshot.started
+		)
+		if result["conserved"]:
+			logging.info("Global snapshot %s: total=%d (in transit %d), money conserved.",
+						 snapshot.marker_id, total, snapshot.in_transit)
+		else:
+			logging.error("Global snapshot %s: total=%d (in transit %d) differs from expected total %d.",
+						  snapshot.marker_id, total, snapshot.in_transit, self.expected_total)
+
+		if self._results_file is not None:
+			with open(self._results_file, "a") as f:
+				f.write(json.dumps(result) + "\n")
+		return result
+
+
+class SnapshotStore:
+	"""
+	Append-only store of local state reports and assembled global snapshots. Records are appended
+	to segment files (a new segment is started when the current one is full), every record has
+	a header with its kind, marker_id and bank_id followed by JSON payload:
+
+		<payload length: uint32><kind: uint8><marker_id: int64><bank_id length: uint16><bank_id><payload>
+
+	Index (marker_id -> bank_id -> record location) is kept in memory and rebuilt from the headers
+	when the store is opened. Records are read from memory-mapped segments, only a few recently read
+	segments are kept mapped so large store fits into address space of 32-bit system. Incomplete record at the end
+	of the last segment (torn write) is cut off when the store is opened, so new records follow the last
+	complete one.
+	"""
+
+	HEADER = struct.Struct("!IBqH")
+
+	KIND_REPORT = 1
+	KIND_GLOBAL = 2
+
+	# bank_id of global snapshot records
+	GLOBAL_BANK_ID = ""
+
+	def __init__(self, directory, segment_size=64 * 1024 * 1024, max_maps=4):
+		"""
+		:param str directory: Directory with segment files, it's created if it doesn't exist.
+		:param int segment_size: Size (in bytes) after which a new segment is started.
+		:param int max_maps: Max number of segments mapped at a time.
+		"""
+		self._directory = directory
+		self._segment_size = segment_size
+		self._max_maps = max(1, max_maps)
+
+		# marker_id -> bank_id -> (segment number, offset of payload, payload length)
+		self._index = dict()
+
+		# segment number -> mmap of the segment, ordered from the least recently used one
+		self._maps = OrderedDict()
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		segments = sorted(int(f[len("segment-"):-len(".dat")]) for f in os.listdir(directory)
+						  if f.startswith("segment-") and f.endswith(".dat"))
+		end = 0
+		for segment in segments:
+			end = self._load_segment(segment)
+
+		self._segment = segments[-1] if len(segments) > 0 else 1
+		path = self._segment_path(self._segment)
+		if os.path.isfile(path) and os.path.getsize(path) > end:
+			logging.warning("Cutting off incomplete record at the end of segment %d.", self._segment)
+			os.truncate(path, end)
+		self._file = open(path, "ab")
+		logging.info("Snapshot store '%s' opened, %d snapshots indexed.", directory, len(self._index))
+
+	def _segment_path(self, segment):
+		return os.path.join(self._directory, "segment-%06d.dat" % segment)
+
+	def _load_segment(self, segment):
+		"""
+		Adds records of given segment to the index. Incomplete record at the end (e.g. after crash) is ignored.
+
+		:return: Offset of the end of the last complete record.
+		"""
+		data = self._map(segment)
+		if data is None:
+			return 0
+
+		try:
+			return self._index_records(segment, data)
+		finally:
+			# segment is mapped again once a record is read from it
+			self._unmap(segment)
+
+	def _index_records(self, segment, data):
+		offset = 0
+		header_size = SnapshotStore.HEADER.size
+		while offset + header_size <= len(data):
+			length, kind, marker_id, bank_id_length = SnapshotStore.HEADER.unpack_from(data, offset)
+			payload_offset = offset + header_size + bank_id_length
+			if payload_offset + length > len(data):
+				logging.warning("Incomplete record at the end of segment %d.", segment)
+				break
+
+			bank_id = data[offset + header_size:payload_offset].decode()
+			self._index.setdefault(marker_id, dict())[bank_id] = (segment, payload_offset, length)
+			offset = payload_offset + length
+		return offset
+
+	def _map(self, segment, min_size=0):
+		"""
+		Returns read-only mmap of given segment. Mapping is renewed if it's smaller than min_size
+		(current segment grows), None is returned for empty segment.
+		"""
+		data = self._maps.get(segment)
+		if data is not None and len(data) >= min_size:
+			self._maps.move_to_end(segment)
+			return data
+
+		self._unmap(segment)
+		with open(self._segment_path(segment), "rb") as f:
+			if os.fstat(f.fileno()).st_size == 0:
+				return None
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self._maps[segment] = data
+		while len(self._maps) > self._max_maps:
+			self._maps.popitem(last=False)[1].close()
+		return data
+
+	def _unmap(self, segment):
+		data = self._maps.pop(segment, None)
+		if data is not None:
+			data.close()
+
+	def _append(self, kind, marker_id, bank_id, record):
+		if self._file.tell() >= self._segment_size:
+			self._file.close()
+			self._segment += 1
+			self._file = open(self._segment_path(self._segment), "ab")
+
+		payload = json.dumps(record).encode()
+		bank_id = str(bank_id).encode()
+		offset = self._file.tell()
+		self._file.write(SnapshotStore.HEADER.pack(len(payload), kind, marker_id, len(bank_id)))
+		self._file.write(bank_id)
+		self._file.write(payload)
+		self._file.flush()
+
+		payload_offset = offset + SnapshotStore.HEADER.size + len(bank_id)
+		self._index.setdefault(marker_id, dict())[bank_id.decode()] = (self._segment, payload_offset, len(payload))
+
+	def add_report(self, message):
+		"""
+		Stores local state report of one bank.
+		"""
+		self._append(SnapshotStore.KIND_REPORT, int(message["marker_id"]), message["bank_id"], message)
+
+	def add_global_snapshot(self, result):
+		"""
+		Stores result of assembled global snapshot.
+		"""
+		self._append(SnapshotStore.KIND_GLOBAL, int(result["marker_id"]), SnapshotStore.GLOBAL_BANK_ID, result)
+
+	def marker_ids(self):
+		return sorted(self._index.keys())
+
+	def _read(self, location):
+		segment, offset, length = location
+		data = self._map(segment, offset + length)
+		return json.loads(data[offset:offset + length].decode())
+
+	def get_report(self, marker_id, bank_id):
+		"""
+		Returns stored report of given bank for given snapshot or None if there's none.
+		"""
+		location = self._index.get(marker_id, dict()).get(str(bank_id))
+		return self._read(location) if location is not None else None
+
+	def get_snapshot(self, marker_id):
+		"""
+		Returns everything stored for given snapshot or None if there's nothing.
+
+		:return: Dict with marker_id, reports (bank_id -> report) and global (result of assembly or None).
+		"""
+		records = self._index.get(marker_id)
+		if records is None:
+			return None
+
+		reports = dict((bank_id, self._read(location)) for bank_id, location in records.items()
+					   if bank_id != SnapshotStore.GLOBAL_BANK_ID)
+		result = records.get(SnapshotStore.GLOBAL_BANK_ID)
+		return dict(
+			marker_id=marker_id,
+			reports=reports,
+			global_snapshot=self._read(result) if result is not None else None
+		)
+
+	def close(self):
+		self._file.close()
+		for data in self._maps.values():
+			data.close()
+		self._maps.clear()
+
+
 def print_state_message(message):
 	if "status" in message:
 		# pretty print for status messages
-		logging.info("Status message: marker_id=%s; bank_id=%s; status=%s; channel_messages=%s;"%
-					 (message["marker_id"],
-					  message["bank_id"],
-					  message["status"],
-					  message["channel_messages"]))
+		logging.info("Status message: marker_id=%s; bank_id=%s; status=%s; channels=%s;",
+					 message["marker_id"],
+					 message["bank_id"],
+					 message["status"],
+					 message.get("channel_summaries", message.get("channel_messages")))
+	elif "aborted" in message:
+		logging.warning("Snapshot aborted: marker_id=%s; bank_id=%s; reason=%s;",
+						message["marker_id"],
+						message["bank_id"],
+						message["aborted"])
 	else:
 		# standard logging for everything else
-		logging.info(message)
+		logging.info("%s", message)
+
+
+def record_report_arrival(stats_file, message):
+	"""
+	Appends arrival time of local state report to the stats file (one JSON object per line).
+
+	:param str stats_file: Stats file, nothing is recorded if it's None.
+	:param dict message: Received message.
+	"""
+	if stats_file is None or "status" not in message:
+		return
+
+	with open(stats_file, "a") as f:
+		f.write(json.dumps(dict(marker_id=message["marker_id"], bank_id=message["bank_id"], time=time.time())) + "\n")
+
+
+def export_snapshots(store, marker_id):
+	"""
+	Writes stored snapshots to stdout (one JSON object per line).
 
+	:param SnapshotStore store: Store to read from.
+	:param str marker_id: Id of snapshot to export or 'all'.
+	"""
+	marker_ids = store.marker_ids() if marker_id == "all" else [int(marker_id)]
+	for m in marker_ids:
+		snapshot = store.get_snapshot(m)
+		if snapshot is None:
+			logging.error("Snapshot %s not found.", m)
+			continue
+		sys.stdout.write(json.dumps(snapshot) + "\n")
+
+
+def handle_message(message, decoder, assembler, stats_file=None, store=None):
+	"""
+	Handles one message received from a bank.
 
-def start_listening(configuration):
+	:param dict message: Received message.
+	:param ReportDecoder decoder: Decoder of delta reports.
+	:param SnapshotAssembler assembler: Assembler of global snapshots.
+	:param str stats_file: File to record arrival times of local state reports to.
+	:param SnapshotStore store: Store to persist reports and global snapshots to, None to disable.
+	"""
+	message = decoder.decode(message)
+	if message is None:
+		return
+
+	record_report_arrival(stats_file, message)
+	print_state_message(message)
+	result = assembler.add_message(message)
+
+	if store is not None:
+		if "status" in message:
+			store.add_report(message)
+		if result is not None:
+			store.add_global_snapshot(result)
+
+
+def start_listening(configuration, assembler, stats_file=None, store=None, socket_mode="pair", batch_size=256):
 	"""
 	Starts listening on ports given by configuration and starts to
-	poll bound sockets for incoming messages.
+	poll bound sockets for incoming messages. In 'pair' mode one PAIR socket is bound
+	for every port (one per bank), in 'pull' mode one PULL socket is bound to the first port
+	and all banks connect to it.
 
 	:param dict configuration: "port" should contain list with ports to bind to.
+	:param SnapshotAssembler assembler: Assembler of global snapshots.
+	:param str stats_file: File to record arrival times of local state reports to.
+	:param SnapshotStore store: Store to persist reports and global snapshots to, None to disable.
+	:param str socket_mode: 'pair' or 'pull'.
+	:param int batch_size: Max number of messages received from one socket per poll.
 	:return:
 	"""
+	ports = [port.strip() for port in configuration["ports"] if port.strip() != ""]
+	socket_type = zmq.PAIR
+	if socket_mode == "pull":
+		socket_type = zmq.PULL
+		if len(ports) > 1:
+			logging.warning("Only one port is needed in pull mode, ignoring: %s.", ports[1:])
+		ports = ports[:1]
+
 	# initialize sockets and poller
 	context = zmq.Context()
-	sockets = []
 	poller = zmq.Poller()
-	for port in configuration["ports"]:
-		logging.info("Listening on port: %s" % port.rstrip())
-		s = context.socket(zmq.PAIR)
-		s.bind("tcp://*:%s" % port.rstrip())
+	for port in ports:
+		logging.info("Listening on port: %s", port)
+		s = context.socket(socket_type)
+		s.bind(to_endpoint(port))
 		poller.register(s, zmq.POLLIN)
-		sockets.append(s)
 
 	should_run = True
 
-	# run in loop
+	decoder = ReportDecoder()
+
+	# run in loop, every ready socket is drained (up to the batch size)
 	while should_run:
-		messages = dict(poller.poll(timeout=10))
-		if len(messages) > 0:
-			for socket in sockets:
-				if socket in messages and messages[socket] == zmq.POLLIN:
-					message = socket.recv_json()
-					print_state_message(message)
+		for socket, event in poller.poll(timeout=1000):
+			for _ in range(batch_size):
+				try:
+					frame = socket.recv(zmq.NOBLOCK)
+				except zmq.Again:
+					break
+				handle_message(json.loads(frame.decode()), decoder, assembler, stats_file, store)
+
+
+def to_endpoint(port):
+	"""
+	Converts line of configuration to ZeroMQ endpoint to bind to. Line is either
+	a port or full endpoint (e.g. ipc://collector-1.ipc).
+	"""
+	if "://" in port:
+		return port
+	return "tcp://*:%s" % port
 
 
 def load_configuration():
 	"""
 	Loads port this collector should listen on from configuration file.
-	Each line is expected to contain exactly one port number.
+	Each line is expected to contain exactly one port number (or endpoint), optionally
+	preceded by id of the bank reporting to it (bank_id,port).
 
-	:return:
+	:return: Dict with ports and banks (ids of banks, empty if the lines don't contain them).
 	"""
 	file_name = "collector.txt"
 	if not os.path.isfile(file_name):
-		logging.error("Configuration file %s does not exist." % file_name)
+		logging.error("Configuration file %s does not exist.", file_name)
 		return None
 
 	with open(file_name, "r") as f:
-		lines = f.readlines()
+		lines = [line.strip() for line in f.readlines() if line.strip() != ""]
+
+	ports = []
+	banks = []
+	for line in lines:
+		if "," in line:
+			bank_id, port = line.split(",", 1)
+			banks.append(bank_id.strip())
+			ports.append(port)
+		else:
+			ports.append(line)
 
 	return dict(
-		ports=lines
+		ports=ports,
+		banks=banks
 	)
 
 
-def configure_logging(include_console=False):
+def load_arguments():
+	"""
+	Parses console arguments.
+
+	:return: Parsed arguments or None if they are not valid.
+	"""
+	parser = argparse.ArgumentParser(description="KIV/DS global state collector.")
+	parser.add_argument("--stats-file", default=None,
+						help="File to record arrival times of local state reports to (JSON lines).")
+	parser.add_argument("--results-file", default=None,
+						help="File to append results of assembled global snapshots to (JSON lines).")
+	parser.add_argument("--banks", default=None,
+						help="Comma separated ids of banks taking part in snapshots, overrides ids in collector.txt.")
+	parser.add_argument("--expected-total", type=int, default=None,
+						help="Total money in the system, taken from the first complete snapshot if not set.")
+	parser.add_argument("--socket", choices=["pair", "pull"], default="pair",
+						help="PAIR socket per port (bank) or one PULL socket for all banks.")
+	parser.add_argument("--batch-size", type=int, default=256,
+						help="Max number of messages received from one socket per poll.")
+	parser.add_argument("--store-dir", default="snapshot-store",
+						help="Directory of the snapshot store, 'none' to disable the store.")
+	parser.add_argument("--export", default=None, metavar="MARKER_ID",
+						help="Export snapshot with given marker id (or 'all') from the store to stdout and exit.")
+	parser.add_argument("--log-level", default="INFO", help="Log level (DEBUG, INFO, WARNING, ...).")
+
+	try:
+		return parser.parse_args()
+	except SystemExit:
+		return None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+	"""
+	Queue handler which leaves formatting of records to the listener thread.
+	"""
+
+	def prepare(self, record):
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
+
+def configure_logging(include_console=False, level="INFO"):
+	"""
+	Configures logging to log.txt (and console). Records are written by background thread.
+	"""
 	if os.path.isfile("log.txt"):
 		os.remove("log.txt")
 
-	logging.basicConfig(filename='log.txt',
-						filemode='a',
-						format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-						datefmt='%H:%M:%S',
-						level=logging.DEBUG)
-
+	formatter = logging.Formatter('%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s', datefmt='%H:%M:%S')
+	handlers = [logging.FileHandler('log.txt', mode='a')]
 	if include_console:
-		console = logging.StreamHandler()
-		console.setLevel(logging.DEBUG)
-		logging.getLogger('').addHandler(console)
+		handlers.append(logging.StreamHandler())
+	for handler in handlers:
+		handler.setFormatter(formatter)
+
+	log_queue = queue.Queue()
+	listener = logging.handlers.QueueListener(log_queue, *handlers)
+	listener.start()
+	atexit.register(listener.stop)
+
+	root = logging.getLogger('')
+	root.addHandler(DeferredQueueHandler(log_queue))
+	root.setLevel(level.upper())
 
 
 def main():
-	configure_logging(True)
+	arguments = load_arguments()
+	if arguments is None:
+		return
+
+	store = None
+	if arguments.export is not None:
+		# log file of running collector must not be touched
+		logging.basicConfig(level=arguments.log_level.upper())
+		store = SnapshotStore(arguments.store_dir)
+		export_snapshots(store, arguments.export)
+		store.close()
+		return
+
+	configure_logging(True, arguments.log_level)
 
 	configuration = load_configuration()
 	if configuration is None:
 		return
 
 	logging.info("Starting global state collector.")
-	start_listening(configuration)
+	if arguments.store_dir != "none":
+		store = SnapshotStore(arguments.store_dir)
+	banks = arguments.banks.split(",") if arguments.banks is not None else configuration["banks"]
+	assembler = SnapshotAssembler(expected_total=arguments.expected_total, results_file=arguments.results_file,
+								  banks=banks)
+	start_listening(configuration, assembler, arguments.stats_file, store, arguments.socket, arguments.batch_size)
 
 
 # script body
-main()
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,21 @@
+#
+# Unit tests of the pure-logic parts of the scripts. Scripts live in directories which aren't
+# packages (and state-collector.py isn't a valid module name), so they are loaded from files.
+#
+import importlib.util
+import os
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def load_script(path, name):
+	"""
+	Loads script as a module, its main() isn't run.
+
+	:param str path: Path of the script relative to src directory.
+	:param str name: Name of the module.
+	"""
+	spec = importlib.util.spec_from_file_location(name, os.path.join(SRC_DIR, path))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
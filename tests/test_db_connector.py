@@ -0,0 +1,144 @@
+import unittest
+
+from tests import load_script
+
+bank = load_script("bank/bank.py", "bank")
+
+
+class RecordingBackend(bank.InMemoryBackend):
+	"""
+	In-memory account which records balance updates and can be switched off.
+	"""
+
+	def __init__(self, initial_balance=1000):
+		super().__init__(initial_balance)
+		self.updates = []
+		self.available = True
+
+	def _check(self):
+		if not self.available:
+			raise bank.StorageUnavailableError("storage is down")
+
+	def add_to_balance(self, delta):
+		self._check()
+		self.updates.append(delta)
+		super().add_to_balance(delta)
+
+	def debit_if_enough(self, amount, pending=0):
+		self._check()
+		return super().debit_if_enough(amount, pending)
+
+	def load_balance(self):
+		self._check()
+		return super().load_balance()
+
+
+class GroupCommitTest(unittest.TestCase):
+
+	def test_updates_are_merged_into_net_change(self):
+		backend = RecordingBackend()
+		connector = bank.DbConnector(backend, group_commit_size=4, group_commit_interval=60)
+		connector.credit_money(100)
+		connector.debit_money(30)
+		connector.credit_money(5)
+		self.assertEqual([], backend.updates)
+
+		connector.debit_money(25)
+		self.assertEqual([50], backend.updates)
+		self.assertEqual(1050, backend.load_balance())
+		self.assertIsNone(connector.flush_deadline())
+
+	def test_amount_includes_pending_changes(self):
+		backend = RecordingBackend()
+		connector = bank.DbConnector(backend, group_commit_size=10, group_commit_interval=60)
+		connector.credit_money(100)
+		self.assertEqual(1100, connector.get_amount())
+		self.assertEqual([100], backend.updates)
+
+	def test_pending_changes_kept_while_storage_unavailable(self):
+		backend = RecordingBackend()
+		connector = bank.DbConnector(backend, group_commit_size=2, group_commit_interval=60)
+		backend.available = False
+		connector.credit_money(100)
+		connector.debit_money(30)
+		self.assertFalse(connector.flush())
+		self.assertIsNotNone(connector.flush_deadline())
+		with self.assertRaises(bank.StorageUnavailableError):
+			connector.get_amount()
+
+		backend.available = True
+		self.assertTrue(connector.flush())
+		self.assertEqual([70], backend.updates)
+		self.assertEqual(1070, connector.get_amount())
+
+	def test_direct_updates_kept_while_storage_unavailable(self):
+		backend = RecordingBackend()
+		connector = bank.DbConnector(backend)
+		backend.available = False
+		connector.credit_money(100)
+		connector.credit_money(20)
+
+		backend.available = True
+		connector.credit_money(3)
+		self.assertEqual([123], backend.updates)
+		self.assertEqual(1123, connector.get_amount())
+
+
+class GuardedDebitTest(unittest.TestCase):
+
+	def test_debit_only_if_enough_money(self):
+		connector = bank.DbConnector(bank.SqliteBackend(":memory:", initial_balance=100))
+		self.addCleanup(connector.close_connection)
+		self.assertTrue(connector.try_debit(60))
+		self.assertFalse(connector.try_debit(60))
+		self.assertEqual(40, connector.get_amount())
+
+	def test_guard_counts_pending_changes(self):
+		connector = bank.DbConnector(bank.SqliteBackend(":memory:", initial_balance=100),
+									 group_commit_size=10, group_commit_interval=60)
+		self.addCleanup(connector.close_connection)
+		connector.credit_money(50)
+		self.assertTrue(connector.try_debit(120))
+		# credit is still pending, guard hasn't flushed it
+		self.assertIsNotNone(connector.flush_deadline())
+		self.assertEqual(30, connector.get_amount())
+
+		connector.debit_money(20)
+		self.assertFalse(connector.try_debit(20))
+		self.assertEqual(10, connector.get_amount())
+
+	def test_debit_refused_while_storage_unavailable(self):
+		backend = RecordingBackend()
+		connector = bank.DbConnector(backend)
+		backend.available = False
+		self.assertFalse(connector.try_debit(10))
+		backend.available = True
+		self.assertEqual(1000, connector.get_amount())
+
+
+class BalanceCacheTest(unittest.TestCase):
+
+	def test_cached_balance(self):
+		backend = RecordingBackend()
+		connector = bank.DbConnector(backend, group_commit_size=10, group_commit_interval=60, cache_balance=True)
+		connector.credit_money(100)
+		self.assertTrue(connector.try_debit(1050))
+		self.assertFalse(connector.try_debit(100))
+		self.assertEqual(50, connector.get_amount())
+		# nothing but the initial load has touched the storage
+		self.assertEqual([], backend.updates)
+
+		self.assertTrue(connector.verify_balance())
+		self.assertEqual([-950], backend.updates)
+
+	def test_verify_detects_foreign_change(self):
+		backend = RecordingBackend()
+		connector = bank.DbConnector(backend, cache_balance=True)
+		backend.add_to_balance(5)
+		self.assertFalse(connector.verify_balance())
+		self.assertEqual(1005, connector.resync_balance())
+		self.assertTrue(connector.verify_balance())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from tests import load_script
+
+bank = load_script("bank/bank.py", "bank")
+collector = load_script("state-collector/state-collector.py", "state_collector")
+
+
+def channel(messages, credits, credit_sum, histogram=None):
+	res = dict(messages=messages, credits=credits, credit_sum=credit_sum)
+	if histogram is not None:
+		res["credit_histogram"] = histogram
+	return res
+
+
+def state(marker_id, status, channels):
+	return dict(bank_id="1", marker_id=marker_id, status=status, channel_summaries=channels)
+
+
+class DeltaRoundTripTest(unittest.TestCase):
+
+	def round_trip(self, states, full_every=100):
+		"""
+		Reports given states as deltas and checks the collector rebuilds every one of them.
+
+		:return: Reports sent to the collector.
+		"""
+		reporter = bank.DeltaReporter(delta_reports=True, full_every=full_every)
+		decoder = collector.ReportDecoder()
+		reports = []
+		for local_state in states:
+			report = reporter.report(local_state["marker_id"], local_state)
+			report["bank_id"] = local_state["bank_id"]
+			report["marker_id"] = local_state["marker_id"]
+			reports.append(report)
+			self.assertEqual(local_state, decoder.decode(report))
+		return reports
+
+	def test_first_report_is_full(self):
+		reports = self.round_trip([state(1, 100, {"a": channel(1, 1, 10)})])
+		self.assertNotIn("base_marker_id", reports[0])
+
+	def test_changed_channels(self):
+		reports = self.round_trip([
+			state(1, 100, {"a": channel(1, 1, 10), "b": channel(0, 0, 0)}),
+			state(2, 90, {"a": channel(3, 2, 30), "b": channel(0, 0, 0)}),
+			state(3, 90, {"a": channel(3, 2, 30), "b": channel(1, 0, 0)})
+		])
+		self.assertEqual(1, reports[1]["base_marker_id"])
+		self.assertEqual(-10, reports[1]["status_delta"])
+		self.assertEqual({"a": dict(messages=2, credits=1, credit_sum=20)}, reports[1]["channel_deltas"])
+		self.assertEqual({"b": dict(messages=1)}, reports[2]["channel_deltas"])
+
+	def test_removed_and_new_channels(self):
+		reports = self.round_trip([
+			state(1, 100, {"a": channel(1, 1, 10), "b": channel(2, 0, 0)}),
+			state(2, 100, {"a": channel(1, 1, 10)}),
+			state(3, 100, {"a": channel(1, 1, 10), "c": channel(0, 0, 0)})
+		])
+		self.assertEqual(["b"], reports[1]["removed_channels"])
+		self.assertEqual({"c": channel(0, 0, 0)}, reports[2]["new_channels"])
+
+	def test_histogram_buckets(self):
+		self.round_trip([
+			state(1, 100, {"a": channel(1, 1, 3, {"4": 1})}),
+			state(2, 100, {"a": channel(3, 3, 40, {"4": 1, "32": 2})}),
+			state(3, 100, {"a": channel(2, 2, 60, {"32": 1, "64": 1})}),
+			state(4, 100, {"a": channel(0, 0, 0, {})})
+		])
+
+	def test_every_nth_report_is_full(self):
+		states = [state(m, 100 + m, {"a": channel(m, m, m * 10)}) for m in range(1, 7)]
+		reports = self.round_trip(states, full_every=3)
+		self.assertEqual([True, False, False, True, False, False], ["base_marker_id" not in r for r in reports])
+
+	def test_unknown_base_is_dropped(self):
+		reporter = bank.DeltaReporter(delta_reports=True)
+		decoder = collector.ReportDecoder()
+		reporter.report(1, state(1, 100, {"a": channel(1, 1, 10)}))
+		report = reporter.report(2, state(2, 90, {"a": channel(2, 1, 10)}))
+		report.update(bank_id="1", marker_id=2)
+		self.assertIsNone(decoder.decode(report))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+from tests import load_script
+
+bank = load_script("bank/bank.py", "bank")
+Histogram = bank.Histogram
+
+
+def lower_bound(bucket):
+	return Histogram.bucket_upper_bound(bucket - 1) if bucket > 0 else 0
+
+
+class HistogramTest(unittest.TestCase):
+
+	def test_value_is_within_its_bucket(self):
+		values = list(range(0, 5000)) + [(1 << bits) + d for bits in range(12, 40) for d in (-1, 0, 1)]
+		for us in values:
+			bucket = Histogram._bucket(us)
+			if bucket == Histogram.BUCKET_COUNT - 1:
+				continue
+			self.assertLessEqual(lower_bound(bucket), us, us)
+			self.assertLess(us, Histogram.bucket_upper_bound(bucket), us)
+
+	def test_bounds_are_increasing(self):
+		bounds = [Histogram.bucket_upper_bound(b) for b in range(Histogram.BUCKET_COUNT)]
+		self.assertEqual([1, 2, 3, 4, 5, 6, 7, 8, 10, 12, 14, 16], bounds[:12])
+		for previous, bound in zip(bounds, bounds[1:]):
+			self.assertLess(previous, bound)
+
+	def test_relative_error(self):
+		for bucket in range(8, Histogram.BUCKET_COUNT):
+			self.assertLessEqual(Histogram.bucket_upper_bound(bucket), lower_bound(bucket) * 1.25)
+
+	def test_large_values_go_to_last_bucket(self):
+		self.assertEqual(Histogram.BUCKET_COUNT - 1, Histogram._bucket(1 << 62))
+
+	def test_percentiles(self):
+		histogram = Histogram()
+		self.assertIsNone(histogram.percentile(50))
+		for _ in range(90):
+			histogram.observe(0.000003)
+		for _ in range(10):
+			histogram.observe(0.001)
+
+		self.assertEqual(0.004, histogram.percentile(50))
+		self.assertEqual(0.004, histogram.percentile(90))
+		# 1000 us is in bucket [896, 1024)
+		self.assertEqual(1.024, histogram.percentile(99))
+		self.assertEqual(100, histogram.to_dict()["count"])
+		self.assertEqual([[0.004, 90], [1.024, 10]], histogram.to_dict()["buckets"])
+
+
+if __name__ == "__main__":
+	unittest.main()
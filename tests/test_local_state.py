@@ -0,0 +1,54 @@
+import unittest
+
+from tests import load_script
+
+bank = load_script("bank/bank.py", "bank")
+
+
+class StatesHolderTest(unittest.TestCase):
+
+	def setUp(self):
+		self.holder = bank.StatesHolder()
+
+	def test_complete_after_markers_from_all_channels(self):
+		self.holder.new_global_state(1, 100, "A", ["A", "B", "C"])
+		self.holder.mark_channel_as_complete(1, "B")
+		self.assertFalse(self.holder.is_status_complete(1))
+		self.holder.mark_channel_as_complete(1, "C")
+		self.assertTrue(self.holder.is_status_complete(1))
+
+	def test_initiator_with_no_channels_is_complete(self):
+		self.holder.new_global_state(1, 100, None, [])
+		self.assertTrue(self.holder.is_status_complete(1))
+
+	def test_marker_from_unknown_channel_is_ignored(self):
+		self.holder.new_global_state(1, 100, "A", ["A", "B", "C"])
+		self.holder.mark_channel_as_complete(1, "D")
+		self.holder.mark_channel_as_complete(1, "B")
+		self.assertFalse(self.holder.is_status_complete(1))
+		self.assertNotIn("D", self.holder.get_state(1).to_dict()["channel_summaries"])
+
+		self.holder.mark_channel_as_complete(1, "C")
+		self.assertTrue(self.holder.is_status_complete(1))
+
+	def test_duplicate_marker_is_ignored(self):
+		self.holder.new_global_state(1, 100, None, ["A", "B"])
+		self.holder.mark_channel_as_complete(1, "A")
+		self.holder.mark_channel_as_complete(1, "A")
+		self.assertFalse(self.holder.is_status_complete(1))
+
+	def test_messages_recorded_until_marker(self):
+		self.holder.new_global_state(1, 100, None, ["A", "B"])
+		self.holder.capture_message("A", bank.Message.credit(10))
+		self.holder.capture_message("B", bank.Message.credit(20))
+		self.holder.mark_channel_as_complete(1, "A")
+		self.holder.capture_message("A", bank.Message.credit(30))
+		self.holder.mark_channel_as_complete(1, "B")
+
+		summaries = self.holder.get_state(1).to_dict()["channel_summaries"]
+		self.assertEqual(10, summaries["A"]["credit_sum"])
+		self.assertEqual(20, summaries["B"]["credit_sum"])
+
+
+if __name__ == "__main__":
+	unittest.main()
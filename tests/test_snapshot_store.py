@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests import load_script
+
+collector = load_script("state-collector/state-collector.py", "state_collector")
+
+
+def report(marker_id, bank_id):
+	return dict(marker_id=marker_id, bank_id=bank_id, status=marker_id * 100, channel_summaries={})
+
+
+class SnapshotStoreTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def open_store(self, segment_size=64 * 1024 * 1024):
+		store = collector.SnapshotStore(self.directory, segment_size)
+		self.addCleanup(store.close)
+		return store
+
+	def segment_path(self, segment):
+		return os.path.join(self.directory, "segment-%06d.dat" % segment)
+
+	def test_read_back(self):
+		store = self.open_store()
+		store.add_report(report(1, "1"))
+		store.add_report(report(1, "2"))
+		store.add_global_snapshot(dict(marker_id=1, total=300))
+
+		self.assertEqual(report(1, "2"), store.get_report(1, "2"))
+		snapshot = store.get_snapshot(1)
+		self.assertEqual({"1": report(1, "1"), "2": report(1, "2")}, snapshot["reports"])
+		self.assertEqual(dict(marker_id=1, total=300), snapshot["global_snapshot"])
+		self.assertIsNone(store.get_snapshot(2))
+
+	def test_reopen(self):
+		store = self.open_store(segment_size=100)
+		for marker_id in range(1, 6):
+			store.add_report(report(marker_id, "1"))
+		store.close()
+		self.assertTrue(os.path.isfile(self.segment_path(2)))
+
+		store = self.open_store(segment_size=100)
+		self.assertEqual([1, 2, 3, 4, 5], store.marker_ids())
+		self.assertEqual(report(3, "1"), store.get_report(3, "1"))
+
+		store.add_report(report(6, "1"))
+		self.assertEqual(report(6, "1"), store.get_report(6, "1"))
+
+	def test_segments_are_mapped_lazily(self):
+		store = self.open_store(segment_size=100)
+		for marker_id in range(1, 11):
+			store.add_report(report(marker_id, "1"))
+		store.close()
+
+		store = collector.SnapshotStore(self.directory, segment_size=100, max_maps=2)
+		self.addCleanup(store.close)
+		self.assertEqual(0, len(store._maps))
+		for marker_id in range(1, 11):
+			self.assertEqual(report(marker_id, "1"), store.get_report(marker_id, "1"))
+			self.assertLessEqual(len(store._maps), 2)
+
+	def test_torn_tail(self):
+		store = self.open_store()
+		for marker_id in (1, 2, 3):
+			store.add_report(report(marker_id, "1"))
+		store.close()
+		path = self.segment_path(1)
+		os.truncate(path, os.path.getsize(path) - 3)
+
+		store = self.open_store()
+		self.assertEqual([1, 2], store.marker_ids())
+		store.add_report(report(10, "1"))
+		store.add_report(report(11, "1"))
+		store.close()
+
+		store = self.open_store()
+		self.assertEqual([1, 2, 10, 11], store.marker_ids())
+		self.assertEqual(report(11, "1"), store.get_report(11, "1"))
+		self.assertIsNone(store.get_report(3, "1"))
+
+	def test_torn_header(self):
+		store = self.open_store()
+		store.add_report(report(1, "1"))
+		store.close()
+		with open(self.segment_path(1), "ab") as f:
+			f.write(b"\x00\x00")
+
+		store = self.open_store()
+		self.assertEqual([1], store.marker_ids())
+		store.add_report(report(2, "1"))
+		store.close()
+
+		store = self.open_store()
+		self.assertEqual(report(2, "1"), store.get_report(2, "1"))
+
+
+if __name__ == "__main__":
+	unittest.main()